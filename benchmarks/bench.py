@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+""" Measures the throughput of mapmerge against a stub inkless,  a stand-in wmds and a stand-in broker
+
+    python benchmarks/bench.py --lots 20 --wafers 25 --wafermaps 5
+
+    By default MessageListener.on_message is called directly for each lot,  with --stomp the lots are
+    sent through the broker to a listener that is set up like the one of listen.  Reports lots/sec,
+    the p50 and p99 latency of a lot,  the peak resident memory of the process and the p50 and p99
+    timing of every stage of mapmerge.
+"""
+import math
+import optparse
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCHMARKS)
+# mapmerge is imported like the doctests do,  as a module next to its siblings
+sys.path[:0] = [os.path.join(ROOT, 'mapmerge'), ROOT, BENCHMARKS]
+
+import broker
+import lots
+import mapmerge
+import metrics
+import stomp
+
+from wmdsserver import WMDSServer
+
+NAME_RE = re.compile('<lot [^>]*name="([^"]*)"')
+
+def percentile(values, p):
+  """The nearest rank percentile of a list of values"""
+  values = sorted(values)
+  if len(values) == 0:
+    return 0.0
+  rank = int(math.ceil(p / 100.0 * len(values))) - 1
+  return values[max(0, min(rank, len(values) - 1))]
+
+class Collector(stomp.listener.ConnectionListener):
+  """Records when the result or the exception of each lot arrives"""
+
+  def __init__(self):
+    self.condition = threading.Condition()
+    self.received = {}
+    self.failed = []
+
+  def on_message(self, headers, message):
+    match = NAME_RE.search(message)
+    name = match and match.group(1)
+    self.condition.acquire()
+    try:
+      self.received[name] = time.time()
+      if headers.get('destination') == '/topic/exceptions.postprocessing':
+        self.failed.append(name)
+      self.condition.notifyAll()
+    finally:
+      self.condition.release()
+
+  def wait(self, count, timeout):
+    deadline = time.time() + timeout
+    self.condition.acquire()
+    try:
+      while len(self.received) < count and time.time() < deadline:
+        self.condition.wait(deadline - time.time())
+      return len(self.received) >= count
+    finally:
+      self.condition.release()
+
+def connect(host_and_port, listener=None, destinations=[]):
+  conn = stomp.Connection([host_and_port])
+  if listener != None:
+    conn.set_listener('', listener)
+  conn.start()
+  conn.connect(wait=True)
+  for destination in destinations:
+    conn.subscribe(destination=destination, ack='auto')
+  return conn
+
+def run_direct(conn, messages):
+  """Call on_message for every lot in turn,  returns the latency of each lot"""
+  listener = mapmerge.MessageListener(conn)
+  latencies = []
+  for name, message in messages:
+    start = time.time()
+    listener.on_message({'message-id': name}, message)
+    latencies.append(time.time() - start)
+  return latencies
+
+def run_stomp(host_and_port, collector, messages, workers, queue_size, ack, prefetch, timeout):
+  """Send all lots through the broker to a listener like the one of listen,  returns the latency of each lot"""
+  consumer = stomp.Connection([host_and_port])
+  listener = mapmerge.QueuedListener(mapmerge.MessageListener(consumer, ack), workers, queue_size)
+  consumer.set_listener('', listener)
+  consumer.start()
+  consumer.connect(wait=True)
+  consumer.subscribe({'activemq.prefetchSize': prefetch}, destination='/queue/postprocessing.mapmerge.erfurt.in', ack=ack)
+
+  producer = connect(host_and_port)
+  sent = {}
+  try:
+    for name, message in messages:
+      sent[name] = time.time()
+      producer.send(message, destination='/queue/postprocessing.mapmerge.erfurt.in')
+    if not collector.wait(len(messages), timeout):
+      print >> sys.stderr, 'Only %d of %d lots finished within %d seconds' % (len(collector.received), len(messages), timeout)
+  finally:
+    producer.disconnect()
+    listener.drain()
+    consumer.disconnect()
+  return [collector.received[name] - sent[name] for name in sent if name in collector.received]
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('--lots', type='int', default=10, help='the number of lots to process')
+  parser.add_option('--wafers', type='int', default=25, help='the number of wafers in a lot')
+  parser.add_option('--wafermaps', type='int', default=5, help='the number of wafermaps of a wafer')
+  parser.add_option('--size', type='int', default=16384, help='the size of a wafermap in bytes')
+  parser.add_option('--delay', type='float', default=0.0, help='the seconds inkless takes per wafer')
+  parser.add_option('--outputs', type='int', default=1, help='the number of wafermaps inkless creates')
+  parser.add_option('--output-size', type='int', default=0, help='the size of the created wafermaps,  0 concatenates the inputs')
+  parser.add_option('--no-bulk', action='store_true', help='fetch the wafermaps one by one')
+  parser.add_option('--cache', action='store_true', help='use a wafermap cache,  shared by all lots')
+  parser.add_option('--stomp', action='store_true', help='send the lots through the broker')
+  parser.add_option('--workers', type='int', default=mapmerge.MESSAGE_WORKERS, help='the lots processed at the same time with --stomp')
+  parser.add_option('--ack', default=mapmerge.MESSAGE_ACK, help='how the lots are acknowledged with --stomp,  auto or client-individual')
+  parser.add_option('--prefetch', type='int', help='the unacknowledged lots the broker hands out with --stomp,  by default the workers plus the queued lots')
+  parser.add_option('--timeout', type='float', default=600, help='the seconds to wait for the lots with --stomp')
+  (options, args) = parser.parse_args()
+  if options.prefetch == None:
+    options.prefetch = options.workers + mapmerge.MESSAGE_QUEUE_SIZE
+
+  os.environ['INKLESS_DELAY'] = str(options.delay)
+  os.environ['INKLESS_OUTPUTS'] = str(options.outputs)
+  os.environ['INKLESS_OUTPUT_SIZE'] = str(options.output_size)
+
+  wmds = WMDSServer(bulk=not options.no_bulk)
+  stomp_broker = broker.Broker()
+  cache_dir = None
+
+  mapmerge.MAPMERGE = os.path.join(BENCHMARKS, 'inkless')
+  mapmerge.WMDS_WEBSERVICE = wmds.url
+  mapmerge.wmds.base = wmds.url
+  # the stand-in wmds has a bulk endpoint unless --no-bulk is given,  then the client falls back to single gets
+  mapmerge.wmds.bulk = 'bulk'
+  mapmerge.cache = None
+  stages = metrics.HistogramSink()
+  metrics.sink = stages
+  if options.cache:
+    cache_dir = tempfile.mkdtemp(prefix='mapmerge-cache')
+    mapmerge.cache = mapmerge.WafermapCache(cache_dir, 1024 * 1024 * 1024)
+
+  messages = []
+  for i in range(options.lots):
+    name = 'BENCH%04d' % i
+    messages.append((name, lots.lot(wmds, name, options.wafers, options.wafermaps, options.size)))
+
+  collector = Collector()
+  results = connect(stomp_broker.host_and_port, collector, ['/topic/postprocessing.mapmerge.out', '/topic/exceptions.postprocessing'])
+  try:
+    start = time.time()
+    if options.stomp:
+      latencies = run_stomp(stomp_broker.host_and_port, collector, messages, options.workers, mapmerge.MESSAGE_QUEUE_SIZE, options.ack, options.prefetch, options.timeout)
+    else:
+      sender = connect(stomp_broker.host_and_port)
+      try:
+        latencies = run_direct(sender, messages)
+      finally:
+        sender.disconnect()
+      collector.wait(len(messages), options.timeout)
+    elapsed = time.time() - start
+  finally:
+    results.disconnect()
+    mapmerge.session.close()
+    wmds.shutdown()
+    stomp_broker.shutdown()
+    if cache_dir != None:
+      shutil.rmtree(cache_dir, ignore_errors=True)
+
+  mode = 'direct'
+  if options.stomp:
+    mode = 'stomp'
+  print '%s: %d lots of %d wafers with %d wafermaps of %d bytes' % (mode, options.lots, options.wafers, options.wafermaps, options.size)
+  print 'lots/sec:     %.2f' % (len(latencies) / elapsed)
+  print 'p50 latency:  %.1f ms' % (percentile(latencies, 50) * 1000)
+  print 'p99 latency:  %.1f ms' % (percentile(latencies, 99) * 1000)
+  # ru_maxrss is in kilobytes on linux
+  print 'peak rss:     %.1f MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+  print 'failed lots:  %d' % len(collector.failed)
+  print
+  print '%-10s %8s %10s %10s' % ('stage', 'count', 'p50 ms', 'p99 ms')
+  for stage in stages.stages():
+    print '%-10s %8d %10.1f %10.1f' % (stage, stages.count(stage), stages.percentile(stage, 50) * 1000, stages.percentile(stage, 99) * 1000)
+  if len(collector.failed) > 0:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+""" A local stand-in for the stomp broker
+
+    Speaks enough stomp 1.0 for mapmerge and the benchmarks:  messages sent to a
+    /queue/ go to one subscriber,  messages sent to a /topic/ go to every subscriber.
+    Queued messages wait until a subscriber arrives.
+
+    Like activemq a subscriber with ack client or client-individual gets at most
+    activemq.prefetchSize unacknowledged messages of a queue at a time,  and the messages
+    it did not acknowledge are handed to another subscriber when it disconnects.
+"""
+import SocketServer
+import itertools
+import threading
+
+from stomp import utils
+
+# the prefetch of activemq for queues
+DEFAULT_PREFETCH = 1000
+
+class Broker:
+  """Serves stomp on a free port of localhost in a background thread"""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    # destination -> list of subscribed sessions
+    self.subscriptions = {}
+    # queue -> messages waiting for a subscriber
+    self.pending = {}
+    self.ids = itertools.count(1)
+    self.server = _Server(('127.0.0.1', 0), _Session)
+    self.server.broker = self
+    self.host_and_port = self.server.server_address
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+  def shutdown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def subscribe(self, session, destination, headers):
+    self.lock.acquire()
+    try:
+      self.subscriptions.setdefault(destination, []).append((session, headers))
+      deliveries = self._dispatch(destination)
+    finally:
+      self.lock.release()
+    self._deliver(destination, deliveries)
+
+  def unsubscribe(self, session, destination=None):
+    """Remove the subscription of session to destination,  without a destination the session is gone and
+       its unacknowledged messages are redelivered"""
+    self.lock.acquire()
+    try:
+      if destination != None:
+        self.subscriptions[destination] = [(s, h) for s, h in self.subscriptions.get(destination, []) if s is not session]
+        return
+      for destination, subscribers in self.subscriptions.items():
+        self.subscriptions[destination] = [(s, h) for s, h in subscribers if s is not session]
+      # redeliver the messages the session did not acknowledge,  in their original order
+      unacked = sorted(session.unacked.items())
+      session.unacked.clear()
+      for message_id, (destination, body) in reversed(unacked):
+        self.pending.setdefault(destination, []).insert(0, body)
+      deliveries = [(destination, self._dispatch(destination)) for destination in set([d for i, (d, b) in unacked])]
+    finally:
+      self.lock.release()
+    for destination, messages in deliveries:
+      self._deliver(destination, messages)
+
+  def ack(self, session, message_id):
+    self.lock.acquire()
+    try:
+      acked = session.unacked.pop(message_id, None)
+      deliveries = []
+      if acked != None:
+        deliveries = self._dispatch(acked[0])
+    finally:
+      self.lock.release()
+    if acked != None:
+      self._deliver(acked[0], deliveries)
+
+  def publish(self, destination, body):
+    self.lock.acquire()
+    try:
+      if destination.startswith('/queue/'):
+        self.pending.setdefault(destination, []).append(body)
+        deliveries = self._dispatch(destination)
+      else:
+        message_id = self._message_id()
+        deliveries = [(session, headers, message_id, body) for session, headers in self.subscriptions.get(destination, [])]
+    finally:
+      self.lock.release()
+    self._deliver(destination, deliveries)
+
+  def _message_id(self):
+    # zero padded,  so the ids sort in the order the messages were sent
+    return 'message-%09d' % self.ids.next()
+
+  def _dispatch(self, destination):
+    """Take the pending messages of a queue that its subscribers have room for,  round robin.
+
+       Must be called with the lock held,  returns the messages to deliver.
+    """
+    pending = self.pending.get(destination, [])
+    subscribers = self.subscriptions.get(destination, [])
+    deliveries = []
+    while len(pending) > 0:
+      ready = [i for i, (session, headers) in enumerate(subscribers) if _has_room(session, destination, headers)]
+      if len(ready) == 0:
+        break
+      (session, headers) = subscribers.pop(ready[0])
+      subscribers.append((session, headers))
+      body = pending.pop(0)
+      message_id = self._message_id()
+      if headers.get('ack', 'auto') != 'auto':
+        session.unacked[message_id] = (destination, body)
+      deliveries.append((session, headers, message_id, body))
+    return deliveries
+
+  def _deliver(self, destination, deliveries):
+    for session, headers, message_id, body in deliveries:
+      frame_headers = {'destination': destination, 'message-id': message_id}
+      if 'id' in headers:
+        frame_headers['subscription'] = headers['id']
+      session.send_frame('MESSAGE', frame_headers, body)
+
+def _has_room(session, destination, headers):
+  if headers.get('ack', 'auto') == 'auto':
+    return True
+  prefetch = int(headers.get('activemq.prefetchSize', DEFAULT_PREFETCH))
+  return len([d for d, b in session.unacked.values() if d == destination]) < prefetch
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+class _Session(SocketServer.BaseRequestHandler):
+
+  def setup(self):
+    self.send_lock = threading.Lock()
+    # message-id -> (destination, body) of the delivered messages that are not acknowledged yet
+    self.unacked = {}
+
+  def send_frame(self, command, headers, body=''):
+    lines = [command] + ['%s:%s' % (key, value) for key, value in headers.items()]
+    lines.append('content-length:%d' % len(body))
+    frame = '\n'.join(lines) + '\n\n' + body + '\x00'
+    self.send_lock.acquire()
+    try:
+      self.request.sendall(frame)
+    except IOError:
+      pass
+    finally:
+      self.send_lock.release()
+
+  def frames(self):
+    """Yield the (command, headers, body) of the frames received from the client"""
+    parser = utils.FrameParser()
+    while parser.receive(self.request) > 0:
+      for frame in parser.frames():
+        yield frame
+
+  def handle(self):
+    broker = self.server.broker
+    try:
+      for (command, headers, body) in self.frames():
+        if command in ('CONNECT', 'STOMP'):
+          self.send_frame('CONNECTED', {'session': id(self)})
+        elif command == 'SUBSCRIBE':
+          broker.subscribe(self, headers['destination'], headers)
+        elif command == 'UNSUBSCRIBE':
+          broker.unsubscribe(self, headers['destination'])
+        elif command == 'SEND':
+          broker.publish(headers['destination'], body)
+        elif command == 'ACK':
+          broker.ack(self, headers['message-id'])
+        if 'receipt' in headers:
+          self.send_frame('RECEIPT', {'receipt-id': headers['receipt']})
+        if command == 'DISCONNECT':
+          break
+    finally:
+      broker.unsubscribe(self)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+""" Generates lots like example.xml with any number of wafers and wafermaps """
+import random
+
+LOT = """<?xml version="1.0" encoding="UTF-8"?>
+<lot xmlns="http://cmdb.elex.be/products/electronic-wafermapping/schemas/lot"
+     xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+     xsi:schemaLocation="http://cmdb.elex.be/products/electronic-wafermapping/schemas/lot http://cmdb.elex.be/products/electronic-wafermapping/schemas/lot.xsd"
+     name="%(name)s" wafersInLot="%(count)d">
+    <configuration-parameters>
+        <parameter key="config" value="test"/>
+        <parameter key="processStep" value="pactech"/>
+    </configuration-parameters>
+%(wafers)s
+</lot>
+"""
+
+WAFER = """    <wafer number="%(number)d" passdies="3730">
+        <wafer-properties>
+            <parameter key="processStep" value="pactech"/>
+            <parameter key="buildAt" value="20120302T11:53"/>
+            <parameter key="origin" value="MapMerge"/>
+            <parameter key="site" value="erfurt"/>
+        </wafer-properties>
+        <wafermaps>
+%(wafermaps)s
+        </wafermaps>
+    </wafer>"""
+
+WAFERMAP = """            <wafermap name="%(name)s">
+                <formats>
+                    <format name="TH01">%(reference)s</format>
+                </formats>
+            </wafermap>"""
+
+def wafermap(size, seed):
+  """Return size bytes of wafermap data that are different for every seed"""
+  generator = random.Random(seed)
+  dies = '.XX1234'
+  row = ''.join([generator.choice(dies) for i in range(80)]) + '\n'
+  header = 'WAFERMAP %s\n' % seed
+  return (header + row * (size / len(row) + 1))[:max(size, len(header))]
+
+def lot(wmds, name, wafers, wafermaps, size):
+  """Return the xml of a lot with the given number of wafers and wafermaps per wafer.
+
+     The wafermaps of size bytes are added to the stand-in wmds first.
+  """
+  xml = []
+  for number in range(1, wafers + 1):
+    references = []
+    for i in range(wafermaps):
+      reference = wmds.add(wafermap(size, '%s-%d-%d' % (name, number, i)))
+      references.append(WAFERMAP % {'name': 'map%d' % i, 'reference': reference})
+    xml.append(WAFER % {'number': number, 'wafermaps': '\n'.join(references)})
+  return LOT % {'name': name, 'count': wafers, 'wafers': '\n'.join(xml)}
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+""" A content addressed cache of wafermaps on the local disk.
+
+    Wafermaps in the wmds are stored by their sha1 hash,  so the wafermap behind a
+    reference never changes and can be kept without ever being invalidated.
+"""
+from __future__ import with_statement
+
+import errno
+import logging
+import os
+import re
+import shutil
+import stat
+import threading
+
+from tempfile import mkstemp
+
+logger = logging.getLogger(__name__)
+
+REFERENCE_RE = re.compile('^[0-9a-f]{40}$')
+
+class WafermapCache:
+  """Keeps wafermaps in a directory,  one read only file per reference.
+
+     When the cached wafermaps take more then max_size bytes the least recently used ones are removed until
+     they take at most low_watermark times max_size,  so the cache isn't scanned again on every following put.
+
+     >>> from tempfile import mkdtemp
+     >>> d = mkdtemp()
+     >>> c = WafermapCache(d + '/cache', 10)
+     >>> c.get('07c215caa72d9b24746c2f3f1944b31a1c402643', d + '/wafermap')
+     False
+     >>> c.put('07c215caa72d9b24746c2f3f1944b31a1c402643', 'WMAP1')
+     >>> c.get('07c215caa72d9b24746c2f3f1944b31a1c402643', d + '/wafermap')
+     True
+     >>> open(d + '/wafermap').read()
+     'WMAP1'
+
+     Adding more data then fits in the cache removes the oldest wafermaps.
+     >>> c.put('716c6b31cc6f3be514269de58c4097da89abdcdc', 'WMAP2')
+     >>> c.put('c3fe9bd4777d868cea2dd79ebfe569cc6bcbed02', 'WMAP3')
+     >>> c.get('07c215caa72d9b24746c2f3f1944b31a1c402643', d + '/wafermap2')
+     False
+     >>> c.get('c3fe9bd4777d868cea2dd79ebfe569cc6bcbed02', d + '/wafermap3')
+     True
+     >>> c.size
+     5
+     >>> shutil.rmtree(d)
+  """
+
+  def __init__(self, directory, max_size, low_watermark=0.9):
+    self.directory = directory
+    self.max_size = max_size
+    self.low_watermark = low_watermark
+    self.lock = threading.Lock()
+    self.size = None
+
+  def cacheable(self, reference):
+    """Only sha1 references are cached,  which also keeps them from escaping the cache directory"""
+    return reference != None and REFERENCE_RE.match(reference) != None
+
+  def _path(self, reference):
+    return os.path.join(self.directory, reference)
+
+  def _scan(self):
+    """Create the cache directory and calculate the size of the cached wafermaps"""
+    if self.size == None:
+      if not os.path.isdir(self.directory):
+        os.makedirs(self.directory)
+      self.size = sum([size for path, size, used in self._entries()])
+
+  def _entries(self):
+    entries = []
+    for name in os.listdir(self.directory):
+      if not self.cacheable(name):
+        continue
+      try:
+        st = os.stat(self._path(name))
+      except OSError:
+        continue
+      entries.append((self._path(name), st.st_size, st.st_mtime))
+    return entries
+
+  def get(self, reference, filename):
+    """Link or copy the cached wafermap for reference to filename,  returns False when it isn't cached"""
+    if not self.cacheable(reference):
+      return False
+    path = self._path(reference)
+    try:
+      try:
+        os.link(path, filename)
+      except OSError, e:
+        if e.errno != errno.EXDEV:
+          raise
+        shutil.copyfile(path, filename)
+      # the modification time of a cached wafermap is the last time it was used
+      os.utime(path, None)
+    except (IOError, OSError):
+      return False
+    return True
+
+  def put(self, reference, wafermap):
+    """Add a wafermap to the cache"""
+    self.write(reference, lambda f: f.write(wafermap))
+
+  def write(self, reference, fill):
+    """Add a wafermap to the cache by calling fill with the file the wafermap should be written to.
+
+       Returns False without calling fill when the reference can't be cached.
+    """
+    if not self.cacheable(reference):
+      return False
+    path = self._path(reference)
+    with self.lock:
+      self._scan()
+    if os.path.exists(path):
+      return True
+
+    (fd, tmp) = mkstemp(dir=self.directory, prefix='.')
+    try:
+      f = os.fdopen(fd, 'wb')
+      try:
+        fill(f)
+      finally:
+        f.close()
+      # cached files are shared by hard links,  make sure nobody changes them in place
+      os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+      size = os.stat(tmp).st_size
+      with self.lock:
+        if os.path.exists(path):
+          os.unlink(tmp)
+          return True
+        os.rename(tmp, path)
+        self.size += size
+        if self.size > self.max_size:
+          self._evict()
+    except:
+      if os.path.exists(tmp):
+        os.unlink(tmp)
+      raise
+    return True
+
+  def _evict(self):
+    """Remove the least recently used wafermaps until the cache fits in low_watermark times max_size"""
+    entries = self._entries()
+    entries.sort(key=lambda entry: entry[2])
+    self.size = sum([size for path, size, used in entries])
+    for path, size, used in entries:
+      if self.size <= self.max_size * self.low_watermark:
+        break
+      logger.debug('Removing wafermap %s from the cache' % path)
+      try:
+        os.unlink(path)
+      except OSError:
+        continue
+      self.size -= size
@@ -9,6 +9,68 @@ HOSTS = [("esb-a-test", 61501),("esb-b-test", 61501)]
 
 WMDS_WEBSERVICE = 'http://ewaf-test.colo.elex.be:8181/cxf/api/wafermap/'
 
+# the path of the bulk endpoint relative to WMDS_WEBSERVICE,  which returns many wafermaps in one tar stream.
+# None fetches the wafermaps one by one,  as does a wmds that answers the first bulk request with an error.
+WMDS_BULK = None
+
+# the maximum number of wafers of a lot that are merged at the same time
+MAPMERGE_WORKERS = 4
+
+# directory in which the compiled xml templates are cached between runs,  None compiles them in every process
+TEMPLATE_CACHE_DIR = None
+
+# directory in which the input and output wafermaps of inkless are kept,  preferably a ram backed filesystem.
+# when the filesystem is fuller then the watermark ( a fraction between 0 and 1 ) the default temporary directory is used
+SCRATCH_ROOT = '/dev/shm'
+SCRATCH_WATERMARK = 0.5
+
+# inkless is killed when merging a wafer takes longer then this number of seconds,  None waits forever
+INKLESS_TIMEOUT = 600
+
+# the number of bytes of inkless stdout and stderr that are kept for the logs
+INKLESS_OUTPUT_LIMIT = 65536
+
+# the maximum number of merged wafermaps of a lot that are uploaded to the wmds at the same time
+UPLOAD_WORKERS = 4
+
+# the maximum number of wafermaps of a wafer that are fetched from the wmds at the same time
+FETCH_WORKERS = 8
+
+# the number of idle connections kept open to each http server,  and the socket timeout in seconds
+HTTP_POOL_SIZE = 8
+HTTP_TIMEOUT = 60
+
+# directory in which fetched wafermaps are cached and the maximum size of the cache in bytes,
+# set CACHE_DIR to None to disable the cache
+CACHE_DIR = '/var/cache/mapmerge'
+CACHE_SIZE = 1024 * 1024 * 1024
+
+# check that the sha1 of every fetched wafermap matches its reference
+VERIFY_WAFERMAPS = False
+
+# validate every received lot against the bundled subset of lot.xsd before it is merged,  see schema.py
+VALIDATE_LOTS = False
+
+# copy the unchanged parts of a received lot verbatim to the merged lot instead of rendering them again
+RETAIN_FRAGMENTS = False
+
+# the number of lots that are processed at the same time,  and the number of received lots
+# that can wait for a free worker before the stomp receiver thread blocks
+MESSAGE_WORKERS = 2
+MESSAGE_QUEUE_SIZE = 2
+
+# how received lots are acknowledged:  'client-individual' acknowledges a lot once its result or exception
+# is published,  so the broker hands the lots of a crashed mapmerge to another one.  'auto' acknowledges
+# a lot as soon as it is received.
+MESSAGE_ACK = 'client-individual'
+# the number of unacknowledged lots each broker hands out at a time (activemq.prefetchSize),  the lots that
+# are processed plus the lots that wait for a worker keep every worker busy without blocking the receiver
+MESSAGE_PREFETCH = MESSAGE_WORKERS + MESSAGE_QUEUE_SIZE
+
+# where the timings of the stages of each lot and wafer are sent:  a comma separated list of
+# log,  histogram and statsd://host:port,  None disables them
+METRICS = 'log'
+
 LOGFILE = '/var/log/mapmerge.log'
 LOGLEVEL = logging.DEBUG
 LOGHANDLER = logging.handlers.RotatingFileHandler(LOGFILE, maxBytes=524288, backupCount=10)
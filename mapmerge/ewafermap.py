@@ -1,44 +1,85 @@
 #!/usr/bin/env python
 
-from jinja2 import Template
+from jinja2 import DictLoader, Environment, FileSystemBytecodeCache
 from xml.sax import handler, parseString
 
-class Lot:
+try:
+    from xml.parsers import expat
+except ImportError:
+    expat = None
 
-    def __init__(self, name, item, wafersInLot, organization, probelocation, subcontractor, wafers=[], config={}):
+class Lot(object):
+    """A lot with its wafers
+
+       Every instance gets its own wafers and config when they aren't given.
+       >>> Lot('A12345', '201210600', 2, 'IEPER', 'IEPER', 'MLX_BOGUS').wafers is Lot('A12346', '201210600', 2, 'IEPER', 'IEPER', 'MLX_BOGUS').wafers
+       False
+    """
+
+    __slots__ = ('name', 'item', 'wafersInLot', 'organization', 'probelocation', 'subcontractor', 'wafers', 'config', 'fragments')
+
+    def __init__(self, name, item, wafersInLot, organization, probelocation, subcontractor, wafers=None, config=None):
         self.name = name
         self.item = item
         self.wafersInLot = wafersInLot
         self.organization = organization
         self.probelocation = probelocation
         self.subcontractor = subcontractor
+        if wafers == None:
+            wafers = []
         self.wafers = wafers
+        if config == None:
+            config = {}
         self.config = config
+        # the retained xml source of decoded elements,  see LotHandler
+        self.fragments = None
 
     def __repr__(self):
         return "Lot {name: %s, item: %s, wafersInLot: %s, organization: %s, probelocation: %s, subcontractor: %s, wafers: %s, config: %s}" % (self.name, self.item, self.wafersInLot, self.organization, self.probelocation, self.subcontractor, self.wafers, self.config)
 
-class Wafer:
+class Wafer(object):
+    """A wafer with its wafermaps
+
+       Every instance gets its own wafermaps and config when they aren't given.
+       >>> w1 = Wafer(1, 100)
+       >>> w1.wafermaps.append(Wafermap('Postprocessing'))
+       >>> Wafer(2, 200).wafermaps
+       []
+    """
 
-    def __init__(self, number, passdies, wafermaps = [], config={}):
+    __slots__ = ('number', 'passdies', 'wafermaps', 'config', 'fragments')
+
+    def __init__(self, number, passdies, wafermaps=None, config=None):
         self.number = number
         self.passdies = passdies
+        if wafermaps == None:
+            wafermaps = []
         self.wafermaps = wafermaps
+        if config == None:
+            config = {}
         self.config = config
+        # the retained xml source of decoded elements,  see LotHandler
+        self.fragments = None
 
     def __repr__(self):
         return "Wafer {number: %s, passdies: %s, wafermaps: %s, config: %s}" % (self.number, self.passdies, self.wafermaps, self.config)
 
-class Wafermap:
+class Wafermap(object):
+
+    __slots__ = ('name', 'formats')
 
-    def __init__(self, name, formats={}):
+    def __init__(self, name, formats=None):
         self.name = name
+        if formats == None:
+            formats = {}
         self.formats = formats
 
     def __repr__(self):
         return "Wafermap {name: %s, formats: %s}" % (self.name, self.formats)
 
-class Format:
+class Format(object):
+
+    __slots__ = ('reference', 'wafermap')
 
     def __init__(self, reference, wafermap):
         self.reference = reference
@@ -47,9 +88,50 @@ class Format:
     def __repr__(self):
         return "Format {reference: %s, wafermap: %s}" % (self.reference, self.wafermap)
 
-class LotHandler(handler.ContentHandler):
+# configuration and format names repeat in every wafer,  decoded lots share one copy of each name
+_names = {}
+
+def intern_name(name):
+    """Return the shared copy of a configuration or format name
+
+       >>> intern_name(u'processStep') is intern_name(u''.join([u'process', u'Step']))
+       True
+    """
+    if name == None:
+        return None
+    return _names.setdefault(name, name)
 
-    def __init__(self):
+class LotHandler(handler.ContentHandler):
+    """Builds a lot from the events of an xml parser.
+
+       When the utf-8 encoded source of the message is given and the handler is driven by expat,  the
+       source of the configuration-parameters,  wafer-properties and wafermaps elements is kept with the
+       decoded objects.  encode copies these fragments verbatim as long as the objects didn't change.
+
+       >>> msg = open('example.xml').read()
+       >>> l = decode(msg, retain=True)
+       >>> l.wafers[0].wafermaps.append(Wafermap('Postprocessing', {'th01': Format('07c215caa72d9b24746c2f3f1944b31a1c402643', None)}))
+       >>> s = encode(l)
+       >>> '<format name="TH01">' in s, '<wafermap name="Postprocessing">' in s
+       (True, True)
+       >>> [w.name for w in decode(s.encode('utf-8')).wafers[0].wafermaps]
+       [u'dummy', u'Postprocessing']
+
+       Elements whose objects changed are rendered again
+       >>> l.wafers[0].config['origin'] = 'Inkless'
+       >>> '<parameter key="origin" value="MapMerge"/>' in encode(l)
+       False
+       >>> l.wafers[0].wafermaps[0].formats['th01'].reference = 'NEWREF'
+       >>> s = encode(l)
+       >>> '>NEWREF</format>' in s, '<wafermap name="dummy">' in s
+       (True, True)
+    """
+
+    def __init__(self, source=None):
+        if not isinstance(source, str):
+            source = None
+        self.source = source
+        self.parser = None
         self.inLot = False
         self.inConfig = False
         self.inWafer = False
@@ -59,67 +141,162 @@ class LotHandler(handler.ContentHandler):
         self.inFormats = False
         self.inFormat = False
         self.lotconfig = {}
+        # the lot without its wafers is available as soon as the first wafer starts
+        self.header = None
+        # element name -> handler,  so an element doesn't have to be compared with every name
+        self.starts = {
+            'lot': self.startLot,
+            'configuration-parameters': self.startConfig,
+            'parameter': self.startParameter,
+            'wafer': self.startWafer,
+            'wafer-properties': self.startWaferProperties,
+            'wafermaps': self.startWafermaps,
+            'wafermap': self.startWafermap,
+            'formats': self.startFormats,
+            'format': self.startFormat}
+        self.ends = {
+            'lot': self.endLot,
+            'configuration-parameters': self.endConfig,
+            'wafer': self.endWafer,
+            'wafer-properties': self.endWaferProperties,
+            'wafermaps': self.endWafermaps,
+            'wafermap': self.endWafermap,
+            'formats': self.endFormats,
+            'format': self.endFormat}
 
     def startElement(self, name, attrs):
-        if name == 'lot':
-            self.inLot = True
-            self.la = dict(attrs)
-            self.wafers = []
-        elif name == 'configuration-parameters':
-            self.inConfig = True
-            self.lotconfig = {}
-        elif name == 'parameter' and self.inConfig == True:
-            self.lotconfig[attrs.get('key')] = attrs.get('value')
-        elif name == 'wafer':
-            self.inWafer = True
-            self.wa = dict(attrs)
-            self.wafermaps = []
-            self.waferProperties = {}
-        elif name == 'wafer-properties':
-            self.inWaferProperties = True
-        elif self.inWaferProperties and name == 'parameter':
-            self.waferProperties[attrs.get('key')] = attrs.get('value')
-        elif name == 'wafermaps':
-            self.inWafermaps = True
-            self.wafermaps = []
-        elif name == 'wafermap':
-            self.inWafermap = True
-            self.wafermapName = attrs.get('name')
-        elif name == 'formats':
-            self.inFormats = True
-            self.formats = {}
-        elif name == 'format':
-            self.inFormat = True
-            self.formatName = attrs.get('name').lower()
-            self.formatContent = ""
+        start = self.starts.get(name)
+        if start != None:
+            start(attrs)
 
     def endElement(self, name):
-        if name == 'lot':
-            self.inLot = False
-            self.lot = Lot(self.la.get("name"), self.la.get('item'), self.la.get('wafersInLot'), self.la.get('organization'), self.la.get('probelocation'), self.la.get('subcontractor'), self.wafers, self.lotconfig)
-        elif name == 'configuration-parameters':
-            self.inConfig = False
-        elif name == 'wafer':
-            self.inWafer = False
-            self.wafers.append(Wafer(self.wa.get("number"), self.wa.get("passdies"), self.wafermaps, self.waferProperties))
-        elif name == 'wafer-properties':
-            self.inWaferProperties = False
-        elif name == 'wafermaps':
-            self.inWafermaps = False
-        elif name == 'wafermap':
-            self.inWafermap = False
-            self.wafermaps.append(Wafermap(self.wafermapName, self.formats))
-        elif name == 'formats':
-            self.inFormats = False
-        elif name == 'format':
-            self.formats[self.formatName] = Format(self.formatContent, None)
-            self.inFormat = False
+        end = self.ends.get(name)
+        if end != None:
+            end()
+
+    def xmlDecl(self, version, encoding, standalone):
+        # byte offsets can only be used to slice utf-8 sources
+        if encoding != None and encoding.lower() not in ('utf-8', 'utf8'):
+            self.source = None
+
+    def position(self):
+        """The byte offset of the current event in the source,  None when fragments aren't retained"""
+        if self.source == None or self.parser == None:
+            return None
+        return self.parser.CurrentByteIndex
+
+    def outerFragment(self, start):
+        """The source of an element without attributes that started at start and ends at the current event"""
+        end = self.source.find('>', self.parser.CurrentByteIndex) + 1
+        return self.source[start:end].decode('utf-8')
+
+    def innerFragment(self, start):
+        """The source of the content of an element without attributes that started at start and ends at the current event"""
+        begin = self.source.find('>', start) + 1
+        end = self.parser.CurrentByteIndex
+        if begin > end:
+            return None
+        return self.source[begin:end].decode('utf-8')
+
+    def startLot(self, attrs):
+        self.inLot = True
+        self.la = dict(attrs)
+        self.wafers = []
+
+    def startConfig(self, attrs):
+        self.inConfig = True
+        self.configStart = self.position()
+        self.lotconfig = {}
+
+    def startParameter(self, attrs):
+        if self.inConfig == True:
+            self.lotconfig[intern_name(attrs.get('key'))] = attrs.get('value')
+        elif self.inWaferProperties:
+            self.waferProperties[intern_name(attrs.get('key'))] = attrs.get('value')
+
+    def startWafer(self, attrs):
+        if self.header == None:
+            self.header = self.newLot()
+        self.inWafer = True
+        self.waferFragments = {}
+        self.wa = dict(attrs)
+        self.wafermaps = []
+        self.waferProperties = {}
+
+    def startWaferProperties(self, attrs):
+        self.inWaferProperties = True
+        self.waferPropertiesStart = self.position()
+
+    def startWafermaps(self, attrs):
+        self.inWafermaps = True
+        self.wafermapsStart = self.position()
+        self.wafermaps = []
+
+    def startWafermap(self, attrs):
+        self.inWafermap = True
+        self.wafermapName = attrs.get('name')
+
+    def startFormats(self, attrs):
+        self.inFormats = True
+        self.formats = {}
+
+    def startFormat(self, attrs):
+        self.inFormat = True
+        self.formatName = intern_name(attrs.get('name').lower())
+        self.formatContent = []
+
+    def newLot(self):
+        lot = Lot(self.la.get("name"), self.la.get('item'), self.la.get('wafersInLot'), self.la.get('organization'), self.la.get('probelocation'), self.la.get('subcontractor'), self.wafers, self.lotconfig)
+        if hasattr(self, 'configFragment'):
+            lot.fragments = {'configuration-parameters': self.configFragment}
+        return lot
+
+    def endLot(self):
+        self.inLot = False
+        if self.header == None:
+            self.header = self.newLot()
+        self.lot = self.header
+
+    def endConfig(self):
+        self.inConfig = False
+        if self.configStart != None:
+            self.configFragment = (self.outerFragment(self.configStart), dict(self.lotconfig))
+
+    def endWafer(self):
+        self.inWafer = False
+        wafer = Wafer(self.wa.get("number"), self.wa.get("passdies"), self.wafermaps, self.waferProperties)
+        if len(self.waferFragments) > 0:
+            wafer.fragments = self.waferFragments
+        self.wafers.append(wafer)
+
+    def endWaferProperties(self):
+        self.inWaferProperties = False
+        if self.waferPropertiesStart != None:
+            self.waferFragments['wafer-properties'] = (self.outerFragment(self.waferPropertiesStart), dict(self.waferProperties))
+
+    def endWafermaps(self):
+        self.inWafermaps = False
+        if self.wafermapsStart != None:
+            fragment = self.innerFragment(self.wafermapsStart)
+            if fragment != None:
+                self.waferFragments['wafermaps'] = (fragment, wafermaps_snapshot(self.wafermaps))
+
+    def endWafermap(self):
+        self.inWafermap = False
+        self.wafermaps.append(Wafermap(self.wafermapName, self.formats))
+
+    def endFormats(self):
+        self.inFormats = False
+
+    def endFormat(self):
+        self.formats[self.formatName] = Format("".join(self.formatContent), None)
+        self.inFormat = False
             
     def characters(self, content):
         if self.inFormat == True:
-            self.formatContent = self.formatContent + content.strip()
+            self.formatContent.append(content.strip())
 
-def decode(body):
+def decode(body, retain=False):
   """Parse an xml body to objects
 
      This function will convert an xml message according to the lot.xsd schema to a lot object.
@@ -139,30 +316,90 @@ def decode(body):
      {u'buildAt': u'20120302T11:53', u'origin': u'MapMerge', u'site': u'erfurt', u'processStep': u'pactech'}
      >>> l.wafers[0].wafermaps[0].formats['th01'].reference
      u'07c215caa72d9b24746c2f3f1944b31a1c402643'
+
+     When retain is True the source of unchanged elements is reused by encode,  see LotHandler.
   """
+  if expat != None:
+    return expat_decode(body, retain)
+  return sax_decode(body)
+
+def sax_decode(body):
+  """Parse an xml body to objects using a sax parser"""
   handler = LotHandler()
   parseString(body, handler)
   return handler.lot
 
+def expat_decode(body, retain=False):
+  """Parse an xml body to objects by driving the LotHandler from expat directly.
+
+     This skips the sax layer and lets expat join character data,  which makes it a lot faster then sax_decode.
+     >>> msg = open('example.xml').read()
+     >>> repr(expat_decode(msg)) == repr(sax_decode(msg))
+     True
+  """
+  handler = LotHandler()
+  if retain:
+    handler = LotHandler(body)
+  _expat_parser(handler).Parse(body, True)
+  return handler.lot
+
+def _expat_parser(handler):
+  parser = expat.ParserCreate()
+  parser.buffer_text = True
+  parser.StartElementHandler = handler.startElement
+  parser.EndElementHandler = handler.endElement
+  parser.CharacterDataHandler = handler.characters
+  parser.XmlDeclHandler = handler.xmlDecl
+  handler.parser = parser
+  return parser
+
+def iterdecode(chunks, handler=None):
+  """Parse an xml body given as an iterable of strings and yield (lot, wafer) as soon as a wafer is parsed.
+
+     The lot has the attributes and configuration of the lot and the wafers parsed so far.  Pass a
+     LotHandler to get the completely parsed lot from handler.lot afterwards.
+
+     >>> msg = open('example.xml').read()
+     >>> [(lot.name, wafer.number) for lot, wafer in iterdecode([msg[:500], msg[500:]])]
+     [(u'M31265', u'13')]
+  """
+  if handler == None:
+    handler = LotHandler()
+  if expat == None:
+    parseString("".join(chunks), handler)
+    for wafer in handler.lot.wafers:
+      yield (handler.lot, wafer)
+    return
+
+  parser = _expat_parser(handler)
+  parsed = 0
+  for chunk in chunks:
+    parser.Parse(chunk, False)
+    if handler.header != None:
+      while parsed < len(handler.header.wafers):
+        yield (handler.header, handler.header.wafers[parsed])
+        parsed += 1
+  parser.Parse('', True)
+
 lot_template="""<?xml version="1.0" encoding="UTF-8"?>
 <lot xmlns="http://cmdb.elex.be/products/electronic-wafermapping/schemas/lot"
      xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
      xsi:schemaLocation="http://cmdb.elex.be/products/electronic-wafermapping/schemas/lot http://cmdb.elex.be/products/electronic-wafermapping/schemas/lot.xsd"
      name="{{ lot.name }}" item="{{ lot.item }}" wafersInLot="{{ lot.wafersInLot }}" organization="{{ lot.organization }}" probelocation="{{ lot.probelocation }}" subcontractor="{{ lot.subcontractor }}">
-  <configuration-parameters>
+  {% set fragment = retained(lot, 'configuration-parameters', lot.config) %}{% if fragment %}{{ fragment }}{% else %}<configuration-parameters>
   {% for k,v in lot.config.iteritems() %}
     <parameter key="{{ k }}" value="{{ v }}" />
   {% endfor %}
-  </configuration-parameters>
+  </configuration-parameters>{% endif %}
   {% for wafer in lot.wafers %}
   <wafer number="{{ wafer.number }}" passdies="{{ wafer.passdies }}">
-    <wafer-properties>
+    {% set fragment = retained(wafer, 'wafer-properties', wafer.config) %}{% if fragment %}{{ fragment }}{% else %}<wafer-properties>
     {% for k,v in wafer.config.iteritems() %}
       <parameter key="{{ k }}" value="{{ v }}" />
     {% endfor %}
-    </wafer-properties>
-    <wafermaps>
-    {% for wafermap in wafer.wafermaps %}
+    </wafer-properties>{% endif %}
+    <wafermaps>{% set fragment, skip = retained_wafermaps(wafer) %}{{ fragment }}
+    {% for wafermap in wafer.wafermaps[skip:] %}
       <wafermap name="{{ wafermap.name }}">
       {% for name,format in wafermap.formats.iteritems() %}
         <formats>
@@ -176,6 +413,39 @@ lot_template="""<?xml version="1.0" encoding="UTF-8"?>
   {% endfor %}
 </lot>"""
 
+def retained(element, name, current):
+  """Return the retained source of a decoded element when its contents didn't change,  otherwise an empty string"""
+  if element.fragments == None or name not in element.fragments:
+    return ''
+  (fragment, decoded) = element.fragments[name]
+  if current != decoded:
+    return ''
+  return fragment
+
+def wafermaps_snapshot(wafermaps):
+  """The names and format references of wafermaps,  compared by value to tell whether they changed"""
+  return [(wafermap.name, sorted([(name, format.reference) for name, format in wafermap.formats.items()])) for wafermap in wafermaps]
+
+def retained_wafermaps(wafer):
+  """Return the retained source of the decoded wafermaps of a wafer and the number of wafermaps in it.
+
+     The source can only be reused while the decoded wafermaps are still the first wafermaps of the wafer.
+  """
+  if wafer.fragments == None or 'wafermaps' not in wafer.fragments:
+    return ('', 0)
+  (fragment, decoded) = wafer.fragments['wafermaps']
+  if wafermaps_snapshot(wafer.wafermaps[:len(decoded)]) != decoded:
+    return ('', 0)
+  return (fragment, len(decoded))
+
+# the lot template is compiled once and shared by every call to encode
+environment = Environment(loader=DictLoader({'lot.xml': lot_template}), auto_reload=False)
+environment.globals.update(retained=retained, retained_wafermaps=retained_wafermaps)
+
+def use_bytecode_cache(directory):
+  """Keep the compiled templates in a directory,  so a new process can skip compiling them"""
+  environment.bytecode_cache = FileSystemBytecodeCache(directory)
+
 
 def encode(lot):
   """Encode a lot to xml.
@@ -196,9 +466,35 @@ def encode(lot):
      ...   print ''.join(diff)
      <BLANKLINE>
   """
-  template = Template(lot_template)
+  template = environment.get_template('lot.xml')
   return template.render(lot=lot)
 
+def encode_to(lot, f, chunk_size=65536):
+  """Encode a lot to utf-8 encoded xml and write it to the file f while it is rendered.
+
+     The xml is written in chunks of about chunk_size bytes,  so the document is never in memory at once.
+     >>> w = Wafer(1, 100, [Wafermap('blaat', {'th01': Format('07c215caa72d9b24746c2f3f1944b31a1c402643', None)})])
+     >>> l = Lot("A12345", "201210600", 1, "IEPER", "IEPER", "MLX_BOGUS", [w], {'val1': u'bl\\xfcb'})
+     >>> from StringIO import StringIO
+     >>> f = StringIO()
+     >>> encode_to(l, f, 100)
+     >>> f.getvalue() == encode(l).encode('utf-8')
+     True
+  """
+  template = environment.get_template('lot.xml')
+  chunk = []
+  size = 0
+  for piece in template.generate(lot=lot):
+    data = piece.encode('utf-8')
+    chunk.append(data)
+    size += len(data)
+    if size >= chunk_size:
+      f.write(''.join(chunk))
+      chunk = []
+      size = 0
+  if size > 0:
+    f.write(''.join(chunk))
+
 def eachWafer(l, f):
   """Iterate each wafer in a lot and call f on the wafer
 
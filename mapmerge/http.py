@@ -1,25 +1,321 @@
 #!/usr/bin/env python
-""" Abstraction for urllib2 to make it act as requests
+""" Abstraction for httplib to make it act as requests
     ( we couldn't use requests as it didn't support python 2.5 )
 """
-import urllib2
+import httplib
+import logging
+import os
+import pool
+import socket
+import sys
+import tarfile
+import threading
+import urlparse
+
+# the number of bytes that are read at once when downloading to a file
+CHUNK_SIZE = 65536
+
+# httplib connections take a timeout from python 2.6,  older versions set it on the socket once it is connected
+TIMEOUT_ARGUMENT = sys.version_info >= (2, 6)
+
+logger = logging.getLogger(__name__)
+
+class Session:
+  """Keeps persistent connections to each host open between requests.
+
+     A session can be shared by threads.  A connection is used by one request at a time,
+     after the request at most pool_size idle connections per host are kept open.
+     Timeout is the socket timeout in seconds of every connection,  None blocks forever.
+  """
+
+  def __init__(self, pool_size=4, timeout=None):
+    self.pool_size = pool_size
+    self.timeout = timeout
+    self.lock = threading.Lock()
+    self.idle = {}
+
+  def _acquire(self, host):
+    self.lock.acquire()
+    try:
+      connections = self.idle.get(host)
+      if connections:
+        return connections.pop()
+    finally:
+      self.lock.release()
+
+    (scheme, netloc) = host
+    arguments = {}
+    if TIMEOUT_ARGUMENT:
+      arguments['timeout'] = self.timeout
+    if scheme == 'https':
+      return httplib.HTTPSConnection(netloc, **arguments)
+    else:
+      return httplib.HTTPConnection(netloc, **arguments)
+
+  def _connect(self, conn):
+    """Open the socket of a new connection"""
+    conn.connect()
+    if not TIMEOUT_ARGUMENT:
+      conn.sock.settimeout(self.timeout)
+    # httplib writes a request in several sends,  don't let nagle hold one back until the previous one is
+    # acknowledged on a kept alive connection
+    conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+  def _release(self, host, conn):
+    self.lock.acquire()
+    try:
+      connections = self.idle.setdefault(host, [])
+      if len(connections) < self.pool_size:
+        connections.append(conn)
+        return
+    finally:
+      self.lock.release()
+    conn.close()
+
+  def close(self):
+    """Close all idle connections"""
+    self.lock.acquire()
+    try:
+      idle = self.idle
+      self.idle = {}
+    finally:
+      self.lock.release()
+    for connections in idle.values():
+      for conn in connections:
+        conn.close()
+
+  def _open(self, method, url, headers, data):
+    """Send a request and return the host,  connection and response"""
+    (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+    if query:
+      path = path + '?' + query
+    host = (scheme, netloc)
+
+    # an idle connection may have been closed by the server,  retry once on a new one
+    for attempt in (1, 2):
+      conn = self._acquire(host)
+      if attempt == 2:
+        conn.close()
+        if hasattr(data, 'seek'):
+          data.seek(0)
+      try:
+        if conn.sock == None:
+          self._connect(conn)
+        self._send(conn, method, path or '/', headers, data)
+        return (host, conn, conn.getresponse())
+      except (httplib.HTTPException, socket.error):
+        conn.close()
+        if attempt == 2:
+          raise
+
+  def _send(self, conn, method, path, headers, data):
+    """Send a request with a string or a file as body.
+
+       httplib before python 2.6 can't send a file,  so the body is written here in chunks of CHUNK_SIZE bytes.
+       The Content-Length of a file has to be in headers.
+    """
+    conn.putrequest(method, path)
+    for key, value in headers.items():
+      conn.putheader(key, value)
+    if data != None and not hasattr(data, 'read') and 'content-length' not in [key.lower() for key in headers]:
+      conn.putheader('Content-Length', str(len(data)))
+    conn.endheaders()
+    if hasattr(data, 'read'):
+      while True:
+        chunk = data.read(CHUNK_SIZE)
+        if not chunk:
+          break
+        conn.send(chunk)
+    elif data:
+      conn.send(data)
+
+  def _finish(self, host, conn, resp):
+    """Keep the connection of a completely read response for the next request"""
+    if resp.will_close:
+      conn.close()
+    else:
+      self._release(host, conn)
+
+  def request(self, method, url, headers={}, data=None):
+    (host, conn, resp) = self._open(method, url, headers, data)
+    try:
+      text = resp.read()
+    except:
+      conn.close()
+      raise
+    self._finish(host, conn, resp)
+    return Response(resp.status, text)
+
+  def download(self, url, f, headers={}, chunk_size=CHUNK_SIZE):
+    """Get an url and write the body of a successful response to the file f in chunks of chunk_size bytes.
+
+       The text of the returned response is only read when the request wasn't successful.
+    """
+    (host, conn, resp) = self._open('GET', url, headers, None)
+    try:
+      text = ''
+      if resp.status >= 300:
+        text = resp.read()
+      else:
+        while True:
+          chunk = resp.read(chunk_size)
+          if not chunk:
+            break
+          f.write(chunk)
+    except:
+      conn.close()
+      raise
+    self._finish(host, conn, resp)
+    return Response(resp.status, text)
+
+  def bulk_download(self, url, names, open_file, chunk_size=CHUNK_SIZE):
+    """Post a list of names to url and write each member of the tar stream that is returned to open_file(name).
+
+       The members are written while the stream arrives,  the files returned by open_file are closed afterwards.
+       The text of the returned response is only read when the request wasn't successful.
+    """
+    body = '\n'.join(names)
+    headers = {'Content-Type': 'text/plain', 'Accept': 'application/x-tar'}
+    (host, conn, resp) = self._open('POST', url, headers, body)
+    try:
+      text = ''
+      if resp.status >= 300:
+        text = resp.read()
+      else:
+        archive = tarfile.open(fileobj=resp, mode='r|')
+        for member in archive:
+          if not member.isfile():
+            continue
+          src = archive.extractfile(member)
+          f = open_file(member.name)
+          try:
+            while True:
+              chunk = src.read(chunk_size)
+              if not chunk:
+                break
+              f.write(chunk)
+          finally:
+            f.close()
+        # read the padding after the end of the archive so the connection can be reused
+        while resp.read(chunk_size):
+          pass
+    except:
+      conn.close()
+      raise
+    self._finish(host, conn, resp)
+    return Response(resp.status, text)
+
+  def upload(self, url, f, headers={}, method='PUT'):
+    """Send the contents of the file f as body of a request,  the file is sent in blocks instead of being read at once"""
+    headers = dict(headers)
+    headers['Content-Length'] = str(os.fstat(f.fileno()).st_size)
+    return self.request(method, url, headers, f)
+
+  def get(self, url, headers={}):
+    return self.request('GET', url, headers)
+
+  def put(self, url, headers={}, data=''):
+    return self.request('PUT', url, headers, data)
+
+class Client:
+  """Fetches many wafermaps from the wmds at base at once.
+
+     The references are posted to the bulk endpoint of the wmds,  which returns the wafermaps as a tar stream
+     with a member named after each reference.  When the first bulk request fails without returning a wafermap
+     the wmds is taken not to have a bulk endpoint,  and the wafermaps are fetched with concurrent single gets
+     instead.  A bulk of None always uses single gets.
+
+     >>> from wmdsserver import WMDSServer
+     >>> from StringIO import StringIO
+     >>> def fetch(client, references):
+     ...   files = {}
+     ...   def open_file(reference):
+     ...     files[reference] = StringIO()
+     ...     files[reference].close = lambda: None
+     ...     return files[reference]
+     ...   client.fetch(references, open_file)
+     ...   return sorted([f.getvalue() for f in files.values()])
+     >>> server = WMDSServer()
+     >>> references = [server.add('WMAP%d' % i) for i in range(3)]
+     >>> client = Client(server.url, Session())
+     >>> fetch(client, references)
+     ['WMAP0', 'WMAP1', 'WMAP2']
+     >>> server.requests
+     1
+
+     A wmds without bulk endpoint gets a request per wafermap
+     >>> server.bulk = False
+     >>> client.session.close()
+     >>> client = Client(server.url, Session())
+     >>> fetch(client, references), server.requests
+     (['WMAP0', 'WMAP1', 'WMAP2'], 5)
+     >>> try:
+     ...   fetch(client, ['c3fe9bd4777d868cea2dd79ebfe569cc6bcbed02'])
+     ... except pool.JobsFailed, e:
+     ...   print e.failures[0][0]
+     c3fe9bd4777d868cea2dd79ebfe569cc6bcbed02
+     >>> client.session.close()
+     >>> server.shutdown()
+  """
+
+  def __init__(self, base, session=None, workers=8, bulk='bulk'):
+    self.base = base
+    self.session = session or _session
+    self.workers = workers
+    self.bulk = bulk
+    # None until the first bulk request tells if the wmds supports it
+    self.bulk_supported = None
+
+  def fetch(self, references, open_file, workers=None):
+    """Write the wafermap of every reference to the file returned by open_file(reference)"""
+    references = list(references)
+    if len(references) == 0:
+      return
+    if self.bulk != None and self.bulk_supported != False:
+      if self._fetch_bulk(references, open_file):
+        self.bulk_supported = True
+        return
+      self.bulk_supported = False
+
+    pool.each(references, lambda reference: self._fetch_one(reference, open_file), workers or self.workers, describe=str)
+
+  def _fetch_bulk(self, references, open_file):
+    received = set()
+    def _open_file(reference):
+      if reference not in wanted or reference in received:
+        raise BaseException("The wmds returned an unexpected wafermap %s" % reference)
+      received.add(reference)
+      return open_file(reference)
+    wanted = set(references)
+
+    r = self.session.bulk_download(self.base + self.bulk, references, _open_file)
+    # concurrent first requests can all find out the endpoint is missing
+    if r.status_code >= 300 and len(received) == 0 and self.bulk_supported != True:
+      logger.info('The bulk request to the wmds at %s failed with %d,  fetching wafermaps one by one' % (self.base, r.status_code))
+      return False
+    if r.status_code >= 300:
+      raise BaseException("Unable to fetch wafermaps from the wmds: %d - %s" % (r.status_code, r.text))
+    missing = wanted - received
+    if len(missing) > 0:
+      raise BaseException("Wafermaps with keys %s were not found in the datastore" % ', '.join(sorted(missing)))
+    return True
+
+  def _fetch_one(self, reference, open_file):
+    f = open_file(reference)
+    try:
+      r = self.session.download(self.base + reference, f)
+    finally:
+      f.close()
+    if r.status_code >= 300:
+      raise BaseException("Wafermap with key %s was not found in the datastore" % reference)
+
+_session = Session()
 
 def get(url, headers={}):
-  opener = urllib2.build_opener(urllib2.HTTPHandler)
-  request = urllib2.Request(url)
-  for k,v in headers.iteritems():
-    request.add_header(k,v)
-  resp = opener.open(request)
-  return Response(resp.code, resp.read())
+  return _session.get(url, headers)
 
 def put(url, headers={}, data=''):
-  opener = urllib2.build_opener(urllib2.HTTPHandler)
-  request = urllib2.Request(url, data=data)
-  request.get_method = lambda: 'PUT'
-  for k,v in headers.iteritems():
-    request.add_header(k,v)
-  resp = opener.open(request)
-  return Response(resp.code, resp.read())
+  return _session.put(url, headers, data)
 
 class Response:
 
@@ -29,4 +325,4 @@ class Response:
 
   def __repr__(self):
     return "%d - %s" % (self.status_code, self.text)
-  
\ No newline at end of file
+
@@ -2,6 +2,7 @@
 from __future__ import with_statement
 
 import base64
+import hashlib
 import logging
 import logging.handlers
 import os
@@ -10,37 +11,63 @@ import stomp
 import sys
 import uuid
 import http as requests
+import metrics
+import pool
+import schema
 import shutil
+import signal
+import threading
+import time
 import traceback
 
+from cache import WafermapCache
+from cStringIO import StringIO
 from ewafermap import *
-from tempfile import mkdtemp
-from config import WMDS_WEBSERVICE
+from scratch import ScratchPool
+from config import WMDS_WEBSERVICE, WMDS_BULK
+from config import MAPMERGE_WORKERS
+from config import FETCH_WORKERS
+from config import UPLOAD_WORKERS
+from config import TEMPLATE_CACHE_DIR
+from config import SCRATCH_ROOT, SCRATCH_WATERMARK
+from config import INKLESS_TIMEOUT, INKLESS_OUTPUT_LIMIT
+from config import HTTP_POOL_SIZE, HTTP_TIMEOUT
+from config import CACHE_DIR, CACHE_SIZE
+from config import VERIFY_WAFERMAPS
+from config import RETAIN_FRAGMENTS
+from config import VALIDATE_LOTS
+from config import MESSAGE_WORKERS, MESSAGE_QUEUE_SIZE
+from config import MESSAGE_ACK, MESSAGE_PREFETCH
+from config import METRICS
 from config import LOGLEVEL
 
 MAPMERGE = '/usr/share/ink-tool/bin/inkless'
 
+# the number of bytes of a message that are decoded before the decoded wafers are merged
+DECODE_CHUNK_SIZE = 65536
+
 logger = logging.getLogger(__name__)
 
+# connections to the wmds are shared by all workers
+session = requests.Session(HTTP_POOL_SIZE, HTTP_TIMEOUT)
+wmds = requests.Client(WMDS_WEBSERVICE, session, FETCH_WORKERS, WMDS_BULK)
+
+if TEMPLATE_CACHE_DIR != None:
+  use_bytecode_cache(TEMPLATE_CACHE_DIR)
+
+scratch = ScratchPool(SCRATCH_ROOT, SCRATCH_WATERMARK)
+
+metrics.sink = metrics.create_sink(METRICS)
+
+cache = None
+if CACHE_DIR != None:
+  cache = WafermapCache(CACHE_DIR, CACHE_SIZE)
+
 def format_stacktrace(e):
   """Format an exception with the stacktrace"""
   exc_type, exc_value, exc_traceback = sys.exc_info()
   return "".join(traceback.format_exception(exc_type, exc_value, exc_traceback))
 
-def save_wafermap_formats_to_dir(wafermaps, d):
-  """Save a wafermap in the given directory.
-
-     Wafermaps is a list of tuples containing the name of the wafermap and the wafermap
-  """
-  logger.info("Saving the wafermaps to directory %s" % d)
-  for name, wafermap in wafermaps:
-    filename = d + '/' + uuid.uuid1().hex
-    with open(filename, 'wb') as f:
-      logger.debug("Saving wafermap to file %s" % filename)
-      f.write(wafermap)
-      f.flush()
-      f.close()
-
 def th01_wafermaps_generator(wafer):
   """Generator that selects all th01 wafermaps from a given wafername
 
@@ -62,19 +89,117 @@ def th01_wafermaps_generator(wafer):
           yield (wafermap.name, format.reference)
           
 
-def th01_reference_to_map_generator(references):
-  """Generator that fetches the th01 wafermaps for a list containing the name and reference
+class VerifiedFile:
+  """A file a fetched wafermap is written to,  the sha1 of the wafermap is calculated on the way"""
+
+  def __init__(self, filename):
+    self.f = open(filename, 'wb')
+    self.digest = hashlib.sha1()
+
+  def write(self, data):
+    self.digest.update(data)
+    self.f.write(data)
+
+  def close(self):
+    self.f.close()
+
+def verify_th01_wafermap(ref, digest):
+  """Compare the sha1 of a fetched wafermap with its reference
+
+     >>> f = VerifiedFile(os.devnull)
+     >>> f.write('WMAP'); f.close()
+     >>> verify_th01_wafermap('782dcc19e66f55849b85de9fc3b2e83a29df5d3c', f.digest)
+     >>> try:
+     ...   verify_th01_wafermap('716c6b31cc6f3be514269de58c4097da89abdcdc', f.digest)
+     ... except BaseException, e:
+     ...   print e
+     Wafermap with key 716c6b31cc6f3be514269de58c4097da89abdcdc has a different sha1 782dcc19e66f55849b85de9fc3b2e83a29df5d3c
+  """
+  if digest.hexdigest() != ref:
+    raise BaseException("Wafermap with key %s has a different sha1 %s" % (ref, digest.hexdigest()))
+
+def fetch_th01_wafermaps_to_dir(references, d, workers=FETCH_WORKERS, verify=VERIFY_WAFERMAPS, tags={}):
+  """Fetch the th01 wafermaps for a list containing the name and reference and save them in the given directory.
+
+     Wafermaps found in the cache are linked into the directory,  the others are fetched from the wmds in
+     a single bulk request or with at most workers concurrent requests when the wmds doesn't support that.
+     Each wafermap is saved as soon as it arrives,  with verify its sha1 is checked against its reference
+     while it is written.  The timings of the stages are recorded with tags.
+  """
+  # a wafermap that is used more then once in a wafer is fetched once and linked
+  filenames = {}
+  for name, ref in references:
+    filenames.setdefault(ref, []).append(d + '/' + uuid.uuid1().hex)
+
+  missing = []
+  with metrics.timer('cache', **tags):
+    for ref, names in filenames.iteritems():
+      if cache != None and cache.get(ref, names[0]):
+        logger.debug('Found wafermap %s in the cache' % ref)
+      else:
+        missing.append(ref)
+
+  digests = {}
+  def open_file(ref):
+    if not verify:
+      return open(filenames[ref][0], 'wb')
+    f = VerifiedFile(filenames[ref][0])
+    digests[ref] = f.digest
+    return f
+
+  logger.debug("Fetching %d wafermaps to directory %s" % (len(missing), d))
+  with metrics.timer('fetch', **tags):
+    wmds.fetch(missing, open_file, workers)
+
+  with metrics.timer('save', **tags):
+    for ref in missing:
+      filename = filenames[ref][0]
+      if verify:
+        verify_th01_wafermap(ref, digests[ref])
+      if cache != None:
+        # the wafermap was fetched fine,  a cache that can't keep it mustn't fail the merge
+        try:
+          with open(filename, 'rb') as src:
+            cache.write(ref, lambda f: shutil.copyfileobj(src, f, requests.CHUNK_SIZE))
+        except (IOError, OSError), e:
+          logger.warning('Unable to add wafermap %s to the cache: %s' % (ref, e))
+
+    for ref, names in filenames.iteritems():
+      for filename in names[1:]:
+        os.link(names[0], filename)
+
+def push_wafermap_to_wmds(filename):
+  """Upload a wafermap file to the wmds and return the reference of the wafermap"""
+  with open(filename, 'rb') as f:
+    logger.debug('Starting the upload of %d bytes to %s' % (os.fstat(f.fileno()).st_size, WMDS_WEBSERVICE))
+    resp = session.upload(WMDS_WEBSERVICE, f, headers={'Content-Type': 'application/octet-stream'})
+  logger.debug('Got response %s' % resp)
+  if resp.status_code >= 300:
+    logger.warning('Unable to upload wafermap to the wmds:  %d - %s' % (resp.status_code, resp.text))
+    raise BaseException('Unable to push wafermap to the wmds: %d - %s' % (resp.status_code, resp.text))
+  # the service returns the reference in the body of the put
+  return resp.text
+
+def push_postprocessing_wafermaps_to_wmds(lot, wafer, outd):
+  """Upload the wafermaps mapmerge generated in outd and add them to the wafer.  Removes outd afterwards."""
+  tags = {'lot': lot.name, 'wafer': wafer.number}
+  try:
+    # check for generated wafermaps in the out directory
+    with metrics.timer('collect', **tags):
+      files = [outd + '/' + f for f in os.listdir(outd)]
+
+    logger.debug("Found the following files in the output directory %s" % files)
 
-     >>> [(name, wmap[:4]) for name, wmap in th01_reference_to_map_generator([('test', '716c6b31cc6f3be514269de58c4097da89abdcdc')])]
-     [('test', 'WMAP')]"""
-  for name,ref in references:
-    url = WMDS_WEBSERVICE + ref
-    logger.debug('Getting %s' % url) 
-    r = requests.get(url)
-    if r.status_code > 300:
-        raise BaseException("Wafermap with key %s was not found in the datastore" % ref)
-    yield (name, r.text)
+    # upload every file straight from disk,  so only one wafermap is in memory at a time
+    with metrics.timer('upload', **tags):
+      for filename in files:
+        reference = push_wafermap_to_wmds(filename)
+        logger.debug('Uploaded wafermap %s-%d Postprocessing to the wmds: %s' % (lot.name, int(wafer.number), reference))
+        wafermap = Wafermap('Postprocessing', {'th01': Format(reference, None)})
+        wafer.wafermaps.append(wafermap)
 
+  finally:
+    scratch.release(outd)
 
 class MapMergeException(BaseException):
 
@@ -87,29 +212,147 @@ class MapMergeException(BaseException):
      return """Got return code different then 0:  %d
                  stdout: %s
                  stderr: %s""" % (self.errcode, self.stdout, self.stderr)
-    
-def mapmerge(lot, wafer):
-  """Call mapmerge for a given wafermap.  Save the result of mapmerge in a new wafermap."""
-  # create the temporary directoy for the input wafermaps
+
+  __str__ = __repr__
+
+class MapMergeTimeout(MapMergeException):
+
+  def __init__(self, timeout, stdout, stderr):
+    MapMergeException.__init__(self, None, stdout, stderr)
+    self.timeout = timeout
+
+  def __repr__(self):
+     return """Killed after running for %s seconds
+                 stdout: %s
+                 stderr: %s""" % (self.timeout, self.stdout, self.stderr)
+
+  __str__ = __repr__
+
+class OutputBuffer:
+  """Keeps the last limit bytes written to it
+
+     >>> b = OutputBuffer(5)
+     >>> b.write('abc')
+     >>> b.write('defg')
+     >>> b.getvalue()
+     'cdefg'
+  """
+
+  def __init__(self, limit):
+    self.limit = limit
+    self.chunks = []
+    self.size = 0
+
+  def write(self, data):
+    self.chunks.append(data)
+    self.size += len(data)
+    while self.size - len(self.chunks[0]) >= self.limit:
+      self.size -= len(self.chunks.pop(0))
+
+  def getvalue(self):
+    return "".join(self.chunks)[-self.limit:]
+
+def _drain(pipe, buf):
+  """Read a pipe until it is closed"""
+  while True:
+    data = os.read(pipe.fileno(), 65536)
+    if not data:
+      break
+    buf.write(data)
+
+def run(args, timeout=INKLESS_TIMEOUT, limit=INKLESS_OUTPUT_LIMIT):
+  """Run a command and return its return code,  stdout and stderr.
+
+     Both pipes are drained at the same time,  keeping the last limit bytes of each.  When the command
+     runs longer then timeout seconds its process group is killed and MapMergeTimeout is raised.  Children
+     the command left running in the background are killed at the deadline,  but don't make it time out.
+
+     >>> run(['sh', '-c', 'echo out; echo err >&2; exit 3'])
+     (3, 'out\\n', 'err\\n')
+     >>> try:
+     ...   run(['sh', '-c', 'sleep 10 & echo started; wait'], timeout=0.1)
+     ... except MapMergeTimeout, e:
+     ...   print e.stdout
+     started
+     <BLANKLINE>
+     >>> run(['sh', '-c', 'sleep 10 & echo started'], timeout=0.1)
+     (0, 'started\\n', '')
+  """
+  # run the command in its own process group,  so children it started are killed as well.  The pipes of
+  # commands run at the same time by other threads are closed,  so their end of file doesn't wait on this one.
+  child = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True, preexec_fn=os.setsid)
+  stdout = OutputBuffer(limit)
+  stderr = OutputBuffer(limit)
+  readers = [threading.Thread(target=_drain, args=(child.stdout, stdout)),
+             threading.Thread(target=_drain, args=(child.stderr, stderr))]
+  waiter = threading.Thread(target=child.wait)
   try:
-    ind = mkdtemp(suffix='input')
-    outd = mkdtemp(suffix='output')
+    for thread in readers + [waiter]:
+      thread.setDaemon(True)
+      thread.start()
+
+    deadline = None
+    if timeout != None:
+      deadline = time.time() + timeout
+    # the deadline applies to the command itself
+    waiter.join(timeout)
+
+    if waiter.isAlive():
+      logger.warning("Killing %s after %s seconds" % (args[0], timeout))
+      _killpg(child)
+      waiter.join()
+      for reader in readers:
+        reader.join()
+      raise MapMergeTimeout(timeout, stdout.getvalue(), stderr.getvalue())
+
+    for reader in readers:
+      if deadline == None:
+        reader.join()
+      else:
+        reader.join(max(0, deadline - time.time()))
+    if len([reader for reader in readers if reader.isAlive()]) > 0:
+      # children of the command still hold the pipes open
+      logger.warning("Killing the background processes of %s after %s seconds" % (args[0], timeout))
+      _killpg(child)
+      for reader in readers:
+        reader.join()
+    return (child.returncode, stdout.getvalue(), stderr.getvalue())
+  finally:
+    child.stdout.close()
+    child.stderr.close()
 
-    logger.debug("Created temporary directories %s for input and %s for output" % (ind, outd))
+def _killpg(child):
+  try:
+    os.killpg(child.pid, signal.SIGKILL)
+  except OSError:
+    pass
 
-    # select all th0x wafermaps to save in the in directory
-    wafermaps = th01_reference_to_map_generator(th01_wafermaps_generator(wafer))
+def mapmerge(lot, wafer, uploads=None):
+  """Call mapmerge for a given wafermap.  Upload the result of mapmerge to the wmds and save its reference in a new wafermap.
 
-    # save all selected wafermaps in the in directory
-    save_wafermap_formats_to_dir(wafermaps, ind)
+     When an uploads pool is given the result is uploaded on that pool,  so the caller can merge the next
+     wafer in the meantime.  The job of the upload is returned.
+  """
+  ind = None
+  outd = None
+  start = time.time()
+  tags = {'lot': lot.name, 'wafer': wafer.number}
+  # get the scratch directories for the input and output wafermaps
+  try:
+    ind = scratch.acquire()
+    outd = scratch.acquire()
 
-    child = None
+    logger.debug("Created temporary directories %s for input and %s for output" % (ind, outd))
 
-    try:
-      logger.debug('Creating a subprocess for mapmerge')
-      logger.debug('Starting command %s' % ('%s lot=%s wafer=%d ProcessStep=%s noDB localFolder=%s DestinationDir=%s' % (MAPMERGE, lot.name, int(wafer.number), lot.config['processStep'], ind, outd)))
-      # spawn a new subprocess for mapmerge
-      child = subprocess.Popen([
+    # fetch all th0x wafermaps and save them in the in directory
+    with metrics.timer('select', **tags):
+      references = list(th01_wafermaps_generator(wafer))
+    fetch_th01_wafermaps_to_dir(references, ind, tags=tags)
+
+    logger.debug('Starting command %s' % ('%s lot=%s wafer=%d ProcessStep=%s noDB localFolder=%s DestinationDir=%s' % (MAPMERGE, lot.name, int(wafer.number), lot.config['processStep'], ind, outd)))
+    # run mapmerge in a subprocess
+    with metrics.timer('inkless', **tags):
+      (returncode, stdout, stderr) = run([
         MAPMERGE,
         "lot=%s" % lot.name, 
         "wafer=%d" % int(wafer.number), 
@@ -117,120 +360,246 @@ def mapmerge(lot, wafer):
         "noDB",
         "localFolder=%s" % ind,
         "DestinationDir=%s" % outd
-        ], 
-        stdout=subprocess.PIPE, 
-        stderr=subprocess.PIPE,
-        bufsize=200000)
-
-      stdout = ""
-      stderr = ""
- 
-      while child.returncode == None:
-        stdout = stdout + child.stdout.read()
-        stderr = stderr + child.stderr.read()
-        child.poll()
-      
-      # trigger an exception when the returncode isn't 0
-      if child.returncode != 0:
-        logger.warning("Mapmerge returned with exit code %d" % child.returncode)
-        raise MapMergeException(child.returncode, stdout, stderr)
-
-    finally:
-      if child != None:
-        child.stdout.close()
-        child.stderr.close()
+        ])
 
-    # check for generated wafermaps in the out directory
-    files = [outd + '/' + f for f in os.listdir(outd)]
+    # trigger an exception when the returncode isn't 0
+    if returncode != 0:
+      logger.warning("Mapmerge returned with exit code %d" % returncode)
+      raise MapMergeException(returncode, stdout, stderr)
 
-    logger.debug("Found the following files in the output directory %s" % files)
-    
-    for filename in files:
-      with open(filename, 'rb') as f:
-        contents = f.read()
-        wafermap = Wafermap('Postprocessing', {'th01': Format(None, contents)})
-        wafer.wafermaps.append(wafermap)
+    if uploads == None:
+      push_postprocessing_wafermaps_to_wmds(lot, wafer, outd)
+    else:
+      job = uploads.submit(push_postprocessing_wafermaps_to_wmds, lot, wafer, outd)
+      # the upload removes the output directory when it's done
+      outd = None
+      return job
 
   finally:
-    shutil.rmtree(ind, ignore_errors=True, onerror=None)
-    shutil.rmtree(outd, ignore_errors=True, onerror=None)
+    if ind != None:
+      scratch.release(ind)
+    if outd != None:
+      scratch.release(outd)
+    metrics.record('wafer', time.time() - start, **tags)
     
 
 class MessageListener(stomp.listener.ConnectionListener):
+  """Merges every received lot and publishes the result or the exception.
 
-  def __init__(self, conn):
+     Unless ack is 'auto' a lot is acknowledged after its result or exception is published,  in the
+     same write.
+  """
+
+  def __init__(self, conn, ack='auto'):
     self.conn = conn
+    self.ack = ack
 
   def on_error(self, headers, message):
     print 'Got error %s' % message
 
   def on_message(self, headers, message):
-    lot = decode(message)
-    logger.debug("Received a lot %s" % lot)
+    logger.debug("Received a message of %d bytes" % len(message))
 
     try:
-      # perform mapmerge on each wafer
-      eachWafer(lot, mapmerge)
+      start = time.time()
+      # reject malformed lots before any wafermap is fetched or merged
+      if VALIDATE_LOTS:
+        schema.validate(message)
+
+      handler = LotHandler()
+      if RETAIN_FRAGMENTS:
+        handler = LotHandler(message)
+      describe = lambda wafer: 'wafer %s' % wafer.number
+      uploads = pool.Pool(UPLOAD_WORKERS)
+      try:
+        # perform mapmerge on each wafer as soon as it is decoded,  independent wafers are merged concurrently
+        # and the result of a wafer is uploaded while the next wafers are merged
+        chunks = (message[i:i + DECODE_CHUNK_SIZE] for i in xrange(0, len(message), DECODE_CHUNK_SIZE))
+        decoding = metrics.Stopwatch()
+        wafers = (wafer for lot, wafer in metrics.timed(iterdecode(chunks, handler), decoding))
+        jobs = pool.each(wafers, lambda wafer: mapmerge(handler.header, wafer, uploads), MAPMERGE_WORKERS, describe)
+      finally:
+        uploads.shutdown()
+      lot = handler.lot
+      tags = {'lot': lot.name}
+      metrics.record('decode', decoding.seconds, **tags)
+      logger.debug("Received a lot %s" % lot)
+      pool.wait(zip(lot.wafers, jobs), describe)
+      metrics.record('merge', time.time() - start, **tags)
       logger.debug('Finished mapmerge for %s' % lot.name)
- 
-      def _push_postprocessing_wafermap_to_wmds(lot, wafer):
-        # filter all wafermaps that don't have a reference
-        wafermaps_to_upload = filter(
-            lambda wafermap:  wafermap.formats.has_key('th01') and wafermap.formats['th01'].reference == None, 
-            wafer.wafermaps)
-
-        logger.debug('Number of wafermaps to upload:  %d' % len(wafermaps_to_upload))
- 
-        for wafermap in wafermaps_to_upload:
-          logger.debug('Starting the upload of %d bytes to %s' % (len(wafermap.formats['th01'].wafermap), WMDS_WEBSERVICE))
-          resp = requests.put(WMDS_WEBSERVICE, headers={'Content-Type': 'application/octet-stream'}, data=wafermap.formats['th01'].wafermap)
-          logger.debug('Got response %s' % resp)
-          if resp.status_code < 300:
-            logger.debug('Uploaded wafermap %s-%d Postprocessing to the wmds: %s' % (lot.name, int(wafer.number), resp.text))
-            # the service returns the reference in the body of the put
-            wafermap.formats['th01'].reference = resp.text
-          else:
-            logger.warning('Unable to upload wafermap to the wmds:  %d - %s' % (resp.status_code, resp.text))
-            raise BaseException('Unable to push wafermap to the wmds: %d - %s' % (resp.status_code, resp.text))
-
-      # save the postprocessing wafermap to the wmds            
-      eachWafer(lot, _push_postprocessing_wafermap_to_wmds)
-      response = encode(lot)
+
+      # render the utf-8 encoded result straight into one buffer
+      response = StringIO()
+      with metrics.timer('encode', **tags):
+        encode_to(lot, response)
       # send the result back
-      self.conn.send(response, destination='/topic/postprocessing.mapmerge.out')
+      with metrics.timer('publish', **tags):
+        with self.conn.batch():
+          self.conn.send(response.getvalue(), destination='/topic/postprocessing.mapmerge.out')
+          self.acknowledge(headers)
+      response.close()
+      metrics.record('lot', time.time() - start, **tags)
     except BaseException, e:
       stacktrace = format_stacktrace(e)
       msg = "Got exception while processing message %s:\t\n%s" % (message, stacktrace)
       logger.warning(msg)
-      self.conn.send(msg, destination='/topic/exceptions.postprocessing')
+      with self.conn.batch():
+        self.conn.send(msg, destination='/topic/exceptions.postprocessing')
+        self.acknowledge(headers)
+
+  def acknowledge(self, headers):
+    """Acknowledge the lot received with headers,  unless lots are acknowledged when they arrive"""
+    if self.ack == 'auto':
+      return
+    ack_headers = {'message-id': headers['message-id']}
+    # stomp 1.1 acknowledges a message of a subscription
+    if 'subscription' in headers:
+      ack_headers['subscription'] = headers['subscription']
+    self.conn.ack(ack_headers)
 
   def on_disconnect(self):
     logger.warn('Lost connection to stomp server')
-    
-def listen(hosts):
-  import time
-  logger.info('Starting to listen')
+
+class QueuedListener(stomp.listener.ConnectionListener):
+  """Hand received messages to a pool of workers instead of processing them on the stomp receiver thread.
+
+     This keeps the receiver thread reading frames and heartbeats while lots are merged.  When queue_size
+     messages are already waiting for a worker,  on_message blocks until a worker is free.  Workers is
+     the number of workers or a pool.Pool that is shared with the listeners of other connections.
+     A message whose connection is lost before a worker takes it is skipped,  it isn't acknowledged
+     and the broker hands it out again.
+
+     >>> class Connection:
+     ...   connected = True
+     ...   def is_connected(self): return self.connected
+     >>> class CollectingListener(stomp.listener.ConnectionListener):
+     ...   conn = Connection()
+     ...   messages = []
+     ...   def on_message(self, headers, message): self.messages.append(message)
+     >>> collector = CollectingListener()
+     >>> l = QueuedListener(collector, 1, 1)
+     >>> l.on_message({}, 'lot 1')
+     >>> l.on_message({}, 'lot 2')
+     >>> l.drain()
+     >>> collector.messages
+     ['lot 1', 'lot 2']
+     >>> workers = pool.Pool(2)
+     >>> a, b = QueuedListener(collector, workers), QueuedListener(collector, workers)
+     >>> a.on_message({}, 'lot 3')
+     >>> b.on_message({}, 'lot 4')
+     >>> a.drain(); b.drain()
+     >>> sorted(collector.messages)
+     ['lot 1', 'lot 2', 'lot 3', 'lot 4']
+     >>> collector.conn.connected = False
+     >>> a.on_message({}, 'lot 5')
+     >>> a.drain()
+     >>> len(collector.messages)
+     4
+     >>> workers.shutdown()
+  """
+
+  def __init__(self, listener, workers, queue_size=0):
+    self.listener = listener
+    self.shared = isinstance(workers, pool.Pool)
+    if self.shared:
+      self.workers = workers
+    else:
+      self.workers = pool.Pool(workers, queue_size)
+    # the jobs of this listener that may still be running on a shared pool
+    self.jobs = []
+    self.lock = threading.Lock()
+
+  def on_error(self, headers, message):
+    self.listener.on_error(headers, message)
+
+  def on_disconnected(self):
+    self.listener.on_disconnected()
+
+  def on_message(self, headers, message):
+    job = self.workers.submit(self._process, headers, message)
+    if self.shared:
+      with self.lock:
+        self.jobs = [j for j in self.jobs if not j.done.isSet()] + [job]
+
+  def _process(self, headers, message):
+    # the result of a lot can't be sent anymore,  the broker redelivers the unacknowledged lot
+    if not self.listener.conn.is_connected():
+      logger.debug('Skipping a message of a lost connection')
+      return
+    try:
+      self.listener.on_message(headers, message)
+    except BaseException, e:
+      logger.warning('Unhandled exception while processing a message:\n%s' % format_stacktrace(e))
+
+  def drain(self):
+    """Process all waiting messages and stop the workers,  a shared pool keeps running"""
+    logger.debug('Draining the queued messages')
+    if self.shared:
+      with self.lock:
+        jobs = self.jobs
+        self.jobs = []
+      for job in jobs:
+        job.wait()
+    else:
+      self.workers.shutdown()
+
+def consume(host_and_port, workers, stopping):
+  """Receive lots from one broker and merge them on workers,  reconnecting whenever the connection is lost.
+
+     When the event stopping is set the broker stops handing out lots,  the received lots are finished while
+     their results can still be sent and consume returns.
+  """
   conn = None
-  while True:
-    logger.debug('Trying to connect to stomp server')
+  while not stopping.isSet():
+    logger.debug('Trying to connect to stomp server %s:%d' % host_and_port)
     try: 
-      conn = stomp.Connection(hosts)
-      conn.set_listener('', MessageListener(conn))
+      conn = stomp.Connection([host_and_port])
+      listener = QueuedListener(MessageListener(conn, MESSAGE_ACK), workers)
+      conn.set_listener('', listener)
       conn.start()
       conn.connect()
-      conn.subscribe(destination='/queue/postprocessing.mapmerge.erfurt.in', ack='auto')
-      time.sleep(1)
-      while True and conn.is_connected(): 
-        time.sleep(1)
+      # the broker hands out no more lots than mapmerge can merge or queue,  the others wait for a free worker
+      # here or are handed to another mapmerge
+      conn.subscribe({'activemq.prefetchSize': MESSAGE_PREFETCH}, destination='/queue/postprocessing.mapmerge.erfurt.in', ack=MESSAGE_ACK)
+      stopping.wait(1)
+      while conn.is_connected() and not stopping.isSet():
+        stopping.wait(1)
+      if conn.is_connected():
+        conn.unsubscribe(destination='/queue/postprocessing.mapmerge.erfurt.in')
+        listener.drain()
     except (stomp.exception.NotConnectedException, stomp.exception.ConnectFailedException):
       time.sleep(1)
       pass
     except BaseException, e:
       logger.debug('Got exception %s' % e)
     finally: 
+      # the queued lots of a lost connection are skipped by the workers,  reconnect right away
       if conn != None and conn.is_connected():    
         conn.disconnect()
 
+def listen(hosts, stopping):
+  """Consume the lots of every broker in hosts at the same time,  a list of (hostname, port) tuples.
+
+     Each broker has its own connection and reconnects on its own,  the lots of all brokers are merged
+     by one pool of MESSAGE_WORKERS workers.  Listen returns when the event stopping is set and the
+     received lots are finished.
+  """
+  logger.info('Starting to listen')
+  # every broker can hand out MESSAGE_PREFETCH lots,  the lots that don't fit in the workers wait in the queue
+  workers = pool.Pool(MESSAGE_WORKERS, max(MESSAGE_QUEUE_SIZE, len(hosts) * MESSAGE_PREFETCH - MESSAGE_WORKERS))
+  consumers = []
+  for host_and_port in hosts:
+    consumer = threading.Thread(target=consume, args=(host_and_port, workers, stopping), name='consume %s:%d' % host_and_port)
+    consumer.setDaemon(True)
+    consumer.start()
+    consumers.append(consumer)
+  # joining with a timeout keeps the main thread interruptible,  signal handlers only run between the joins
+  while [consumer for consumer in consumers if consumer.isAlive()]:
+    for consumer in consumers:
+      consumer.join(1)
+  workers.shutdown()
+  logger.info('Stopped listening')
+
 def usage():
   print("Usage:  %s <<hostname>> <<port>>" % sys.argv[0])
 
@@ -246,7 +615,10 @@ def main():
   else:
     [program, hostname, port] = sys.argv
     logger.debug("Starting mapmerge for esb %s and port %d" % (hostname, int(port)))
-    listen(hostname, int(port))
+    stopping = threading.Event()
+    # the init script stops mapmerge with SIGTERM,  finish the received lots before exiting
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    listen([(hostname, int(port))], stopping)
 
 if __name__ == '__main__':
   main()
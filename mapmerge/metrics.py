@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+""" Timings of the stages mapmerge goes through for each lot and wafer
+
+    Every timing is handed to the sink,  which can write it to the log,  send it to a
+    statsd server or keep it in an in-process histogram.
+"""
+from __future__ import with_statement
+
+import logging
+import math
+import random
+import socket
+import threading
+import time
+import urlparse
+
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+class LogSink:
+  """Writes a log line for every timing"""
+
+  def __init__(self, level=logging.INFO):
+    self.level = level
+
+  def record(self, stage, seconds, tags):
+    description = ' '.join(['%s=%s' % (key, tags[key]) for key in sorted(tags)])
+    logger.log(self.level, 'timing %s %.1f ms %s' % (stage, seconds * 1000, description))
+
+class StatsdSink:
+  """Sends every timing as a statsd timer to a statsd server over udp.
+
+     Statsd has no tags,  so the timers of all lots and wafers are combined per stage.
+  """
+
+  def __init__(self, host, port=8125, prefix='mapmerge'):
+    self.address = (host, port)
+    self.prefix = prefix
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+  def record(self, stage, seconds, tags):
+    try:
+      self.socket.sendto('%s.%s:%d|ms' % (self.prefix, stage, int(seconds * 1000)), self.address)
+    except socket.error, e:
+      logger.debug('Unable to send a timing to statsd: %s' % e)
+
+class HistogramSink:
+  """Keeps a random sample of at most size timings per stage in memory.
+
+     >>> sink = HistogramSink()
+     >>> for ms in range(1, 101):
+     ...   sink.record('fetch', ms / 1000.0, {})
+     >>> sink.count('fetch'), sink.percentile('fetch', 50), sink.percentile('fetch', 99)
+     (100, 0.05, 0.099)
+     >>> sink.stages()
+     ['fetch']
+  """
+
+  def __init__(self, size=10000):
+    self.size = size
+    self.lock = threading.Lock()
+    self.samples = {}
+    self.counts = {}
+
+  def record(self, stage, seconds, tags):
+    self.lock.acquire()
+    try:
+      samples = self.samples.setdefault(stage, [])
+      count = self.counts.get(stage, 0) + 1
+      self.counts[stage] = count
+      # reservoir sampling keeps every timing with the same chance once the sample is full
+      if len(samples) < self.size:
+        samples.append(seconds)
+      else:
+        i = random.randint(0, count - 1)
+        if i < self.size:
+          samples[i] = seconds
+    finally:
+      self.lock.release()
+
+  def stages(self):
+    return sorted(self.counts.keys())
+
+  def count(self, stage):
+    return self.counts.get(stage, 0)
+
+  def percentile(self, stage, p):
+    """The nearest rank percentile of the sampled timings of a stage in seconds"""
+    self.lock.acquire()
+    try:
+      samples = sorted(self.samples.get(stage, []))
+    finally:
+      self.lock.release()
+    if len(samples) == 0:
+      return None
+    rank = int(math.ceil(p / 100.0 * len(samples))) - 1
+    return samples[max(0, min(rank, len(samples) - 1))]
+
+class Sinks:
+  """Hands every timing to a list of sinks"""
+
+  def __init__(self, sinks):
+    self.sinks = sinks
+
+  def record(self, stage, seconds, tags):
+    for sink in self.sinks:
+      sink.record(stage, seconds, tags)
+
+def create_sink(spec):
+  """Create the sink described by a comma separated list of log,  histogram and statsd://host:port
+
+     >>> create_sink(None)
+     >>> create_sink('log').__class__.__name__
+     'LogSink'
+     >>> s = create_sink('log, statsd://localhost:8125')
+     >>> [sink.__class__.__name__ for sink in s.sinks], s.sinks[1].address
+     (['LogSink', 'StatsdSink'], ('localhost', 8125))
+  """
+  if spec == None:
+    return None
+  sinks = []
+  for name in [name.strip() for name in spec.split(',') if name.strip()]:
+    if name == 'log':
+      sinks.append(LogSink())
+    elif name == 'histogram':
+      sinks.append(HistogramSink())
+    elif name.startswith('statsd://'):
+      url = urlparse.urlsplit(name)
+      sinks.append(StatsdSink(url.hostname, url.port or 8125))
+    else:
+      raise ValueError("Unknown metrics sink %s" % name)
+  if len(sinks) == 1:
+    return sinks[0]
+  return Sinks(sinks)
+
+# the sink that receives all timings,  None disables them
+sink = None
+
+def record(stage, seconds, **tags):
+  if sink != None:
+    sink.record(stage, seconds, tags)
+
+@contextmanager
+def timer(stage, **tags):
+  """Record how long a with block takes as a stage
+
+     >>> import metrics
+     >>> metrics.sink = HistogramSink()
+     >>> with timer('inkless', lot='A12345', wafer=1):
+     ...   pass
+     >>> metrics.sink.count('inkless')
+     1
+     >>> metrics.sink = None
+  """
+  start = time.time()
+  try:
+    yield
+  finally:
+    record(stage, time.time() - start, **tags)
+
+class Stopwatch:
+  """Adds up the time between each start and stop"""
+
+  def __init__(self):
+    self.seconds = 0.0
+    self.started = None
+
+  def start(self):
+    self.started = time.time()
+
+  def stop(self):
+    self.seconds += time.time() - self.started
+    self.started = None
+
+def timed(iterable, stopwatch):
+  """Iterate over iterable and add the time spent producing its items to stopwatch,  for example to time a parser
+
+     >>> stopwatch = Stopwatch()
+     >>> list(timed(xrange(3), stopwatch)), stopwatch.seconds > 0
+     ([0, 1, 2], True)
+  """
+  iterator = iter(iterable)
+  while True:
+    stopwatch.start()
+    try:
+      item = iterator.next()
+    except StopIteration:
+      stopwatch.stop()
+      return
+    stopwatch.stop()
+    yield item
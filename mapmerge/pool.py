@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+""" A small bounded thread pool
+
+    Mapmerge mostly waits on inkless subprocesses and on the WMDS,  so plain
+    threads are enough to run independent work at the same time.
+"""
+import logging
+import sys
+import threading
+import traceback
+import Queue
+
+logger = logging.getLogger(__name__)
+
+class Job:
+  """The pending result of a function submitted to a pool"""
+
+  def __init__(self, f, args):
+    self.f = f
+    self.args = args
+    self.result = None
+    self.stacktrace = None
+    self.done = threading.Event()
+
+  def run(self):
+    try:
+      self.result = self.f(*self.args)
+    except BaseException:
+      exc_type, exc_value, exc_traceback = sys.exc_info()
+      self.stacktrace = "".join(traceback.format_exception(exc_type, exc_value, exc_traceback))
+    self.done.set()
+
+  def wait(self):
+    """Wait until the job has run,  returns True when it didn't raise an exception"""
+    self.done.wait()
+    return self.stacktrace == None
+
+class Pool:
+  """A fixed number of worker threads executing submitted jobs in order.
+
+     When queue_size is bigger then 0 submit blocks while that many jobs are waiting.
+  """
+
+  def __init__(self, workers, queue_size=0):
+    self.tasks = Queue.Queue(queue_size)
+    self.threads = []
+    for i in range(workers):
+      thread = threading.Thread(target=self._work)
+      thread.setDaemon(True)
+      thread.start()
+      self.threads.append(thread)
+
+  def _work(self):
+    while True:
+      job = self.tasks.get()
+      if job == None:
+        break
+      job.run()
+
+  def submit(self, f, *args):
+    """Schedule f(*args) on the pool and return its Job"""
+    job = Job(f, args)
+    self.tasks.put(job)
+    return job
+
+  def shutdown(self):
+    """Run all submitted jobs and stop the workers"""
+    for thread in self.threads:
+      self.tasks.put(None)
+    for thread in self.threads:
+      thread.join()
+
+class JobsFailed(BaseException):
+
+  def __init__(self, total, failures):
+    self.total = total
+    self.failures = failures
+
+  def __str__(self):
+    return "%d of %d jobs failed:\n%s" % (len(self.failures), self.total,
+      "\n".join(["%s:\n%s" % (name, stacktrace) for name, stacktrace in self.failures]))
+
+def wait(jobs, describe=repr):
+  """Wait for a list of (item, job) tuples and return the results of the jobs.
+
+     When jobs failed a single JobsFailed exception is raised containing the stacktrace of every failure.
+  """
+  failures = [(describe(item), job.stacktrace) for item, job in jobs if not job.wait()]
+  if len(failures) > 0:
+    logger.warning("%d of %d jobs failed" % (len(failures), len(jobs)))
+    raise JobsFailed(len(jobs), failures)
+  return [job.result for item, job in jobs]
+
+def each(items, f, workers, describe=repr):
+  """Call f on every item of an iterable,  running at most workers calls at the same time.
+
+     Every call is finished before each returns the results.  When calls fail a single
+     JobsFailed exception is raised containing the stacktrace of every failure.
+
+     >>> def invert(i): return 1.0 / i
+     >>> each([1, 2, 4], invert, 2)
+     [1.0, 0.5, 0.25]
+     >>> try:
+     ...   each([1, 0, 2, 0], invert, 2)
+     ... except JobsFailed, e:
+     ...   print [name for name, stacktrace in e.failures]
+     ['0', '0']
+  """
+  if hasattr(items, '__len__'):
+    workers = max(1, min(workers, len(items)))
+  pool = Pool(workers)
+  try:
+    # items can be a generator,  every item is submitted as soon as it is generated
+    jobs = [(item, pool.submit(f, item)) for item in items]
+  finally:
+    pool.shutdown()
+  return wait(jobs, describe)
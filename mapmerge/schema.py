@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+""" Streaming validation of lots against the bundled lot.xsd
+
+    The schema is compiled once to a table of element declarations,  after which
+    a message is checked in a single expat pass before any wafer is merged.
+    Only the part of xml schema used by lot.xsd is supported: global and local
+    elements,  named and anonymous complex types with a sequence of elements,
+    attributes and simple content.
+
+    lot.xsd is a subset of the published schema,  so lots are validated against
+    it leniently:  a lax schema ignores the attributes it doesn't declare and the
+    elements that follow the declared children of an element.
+"""
+import os
+import re
+
+from xml.dom import minidom
+from xml.parsers import expat
+
+XS = 'http://www.w3.org/2001/XMLSchema'
+XSI = 'http://www.w3.org/2001/XMLSchema-instance'
+
+LOT_XSD = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lot.xsd')
+
+# the checks of the supported simple types,  a type that isn't listed accepts any text
+SIMPLE_TYPES = {
+  'integer': re.compile(r'^\s*[-+]?[0-9]+\s*$'),
+  'nonNegativeInteger': re.compile(r'^\s*\+?[0-9]+\s*$'),
+  'positiveInteger': re.compile(r'^\s*\+?0*[1-9][0-9]*\s*$'),
+}
+
+class SchemaError(BaseException):
+  """The schema uses a construct the validator doesn't support"""
+
+  def __init__(self, message):
+    self.message = message
+
+  def __str__(self):
+    return self.message
+
+class InvalidLot(BaseException):
+  """A message doesn't conform to the schema"""
+
+  def __init__(self, message, line=None, column=None):
+    self.message = message
+    self.line = line
+    self.column = column
+
+  def __str__(self):
+    if self.line == None:
+      return self.message
+    return "line %d, column %d: %s" % (self.line, self.column, self.message)
+
+class Declaration:
+  """A compiled element declaration"""
+
+  def __init__(self, name):
+    self.name = name
+    # (name, declaration, minOccurs, maxOccurs) of the child elements in order,  maxOccurs None is unbounded
+    self.children = []
+    # attribute name -> type
+    self.attributes = {}
+    self.required = []
+    # the type of the text content,  None when only whitespace is allowed
+    self.text = None
+
+class Schema:
+  """A compiled schema
+
+     >>> schema = Schema(LOT_XSD)
+     >>> schema.validate(open('example.xml').read())
+     >>> def check(body):
+     ...   try:
+     ...     schema.validate('<lot xmlns="http://cmdb.elex.be/products/electronic-wafermapping/schemas/lot" name="A1">%s</lot>' % body)
+     ...   except InvalidLot, e:
+     ...     print e
+     >>> check('<wafer passdies="3730"/>')
+     line 1, column 88: wafer is missing the required attribute number
+     >>> check('<wafer number="1" passdies="-1"/>')
+     line 1, column 88: attribute passdies of wafer is not a valid nonNegativeInteger: u'-1'
+     >>> check('<wafer number="1"><wafermaps/><wafer-properties/></wafer>')
+     line 1, column 118: unexpected element wafer-properties in wafer
+     >>> check('<wafer number="1"><wafermaps><wafermap name="m">WMAP</wafermap></wafermaps></wafer>')
+     line 1, column 140: unexpected text in wafermap
+     >>> check('<wafer number="1">')
+     line 1, column 108: mismatched tag
+  """
+
+  def __init__(self, filename, lax=False):
+    self.lax = lax
+    document = minidom.parse(filename)
+    root = document.documentElement
+    self.namespace = root.getAttribute('targetNamespace') or None
+    self.qualified = root.getAttribute('elementFormDefault') == 'qualified'
+    self.types = {}
+    self.roots = {}
+    # named types can be used before they are declared
+    for node in self._children(root, 'complexType'):
+      self.types[node.getAttribute('name')] = node
+    for node in self._children(root, 'element'):
+      declaration = self._element(node, True)
+      self.roots[declaration.name] = declaration
+    document.unlink()
+
+  def _children(self, node, name=None):
+    children = []
+    for child in node.childNodes:
+      if child.nodeType != child.ELEMENT_NODE:
+        continue
+      if child.namespaceURI != XS:
+        raise SchemaError("unsupported element %s in the schema" % child.tagName)
+      if child.localName in ('annotation', 'documentation'):
+        continue
+      if name == None or child.localName == name:
+        children.append(child)
+    return children
+
+  def _qualify(self, name, top):
+    if self.namespace != None and (top or self.qualified):
+      return self.namespace + ' ' + name
+    return name
+
+  def _local(self, qname):
+    return qname.split(':')[-1]
+
+  def _element(self, node, top=False):
+    if node.getAttribute('ref'):
+      raise SchemaError("element references are not supported")
+    declaration = Declaration(self._qualify(node.getAttribute('name'), top))
+    typename = node.getAttribute('type')
+    types = self._children(node, 'complexType')
+    if typename:
+      if typename in self.types or self._local(typename) in self.types:
+        self._complexType(self.types.get(typename) or self.types[self._local(typename)], declaration)
+      else:
+        declaration.text = self._local(typename)
+    elif len(types) > 0:
+      self._complexType(types[0], declaration)
+    else:
+      declaration.text = 'string'
+    return declaration
+
+  def _complexType(self, node, declaration):
+    for child in self._children(node):
+      if child.localName == 'sequence':
+        self._sequence(child, declaration)
+      elif child.localName == 'attribute':
+        self._attribute(child, declaration)
+      elif child.localName == 'simpleContent':
+        extension = self._children(child)[0]
+        if extension.localName != 'extension':
+          raise SchemaError("unsupported simple content %s" % extension.localName)
+        declaration.text = self._local(extension.getAttribute('base'))
+        for attribute in self._children(extension, 'attribute'):
+          self._attribute(attribute, declaration)
+      else:
+        raise SchemaError("unsupported complex type content %s" % child.localName)
+
+  def _sequence(self, node, declaration):
+    for child in self._children(node):
+      if child.localName != 'element':
+        raise SchemaError("unsupported sequence content %s" % child.localName)
+      minOccurs = int(child.getAttribute('minOccurs') or 1)
+      maxOccurs = child.getAttribute('maxOccurs') or '1'
+      if maxOccurs == 'unbounded':
+        maxOccurs = None
+      else:
+        maxOccurs = int(maxOccurs)
+      element = self._element(child)
+      declaration.children.append((element.name, element, minOccurs, maxOccurs))
+
+  def _attribute(self, node, declaration):
+    name = node.getAttribute('name')
+    declaration.attributes[name] = self._local(node.getAttribute('type') or 'string')
+    if node.getAttribute('use') == 'required':
+      declaration.required.append(name)
+
+  def validate(self, body):
+    """Validate an xml message,  raises InvalidLot at the first error"""
+    validator = Validator(self)
+    parser = expat.ParserCreate(namespace_separator=' ')
+    parser.buffer_text = True
+    parser.StartElementHandler = validator.startElement
+    parser.EndElementHandler = validator.endElement
+    parser.CharacterDataHandler = validator.characters
+    validator.parser = parser
+    try:
+      parser.Parse(body, True)
+    except expat.ExpatError, e:
+      raise InvalidLot(expat.ErrorString(e.code), e.lineno, e.offset)
+
+class Validator:
+  """The state of the validation of one message"""
+
+  def __init__(self, schema):
+    self.schema = schema
+    self.parser = None
+    # [declaration, index of the current child particle, occurrences of that particle, text],  the
+    # declaration is None for elements a lax schema skips
+    self.stack = []
+
+  def fail(self, message):
+    raise InvalidLot(message, self.parser.CurrentLineNumber, self.parser.CurrentColumnNumber)
+
+  def local(self, name):
+    return name.split(' ')[-1]
+
+  def check(self, typename, value, what):
+    pattern = SIMPLE_TYPES.get(typename)
+    if pattern != None and pattern.match(value) == None:
+      self.fail("%s is not a valid %s: %r" % (what, typename, value))
+
+  def startElement(self, name, attrs):
+    if len(self.stack) == 0:
+      declaration = self.schema.roots.get(name)
+      if declaration == None:
+        self.fail("unexpected root element %s" % self.local(name))
+    elif self.stack[-1][0] == None:
+      declaration = None
+    else:
+      declaration = self.child(self.stack[-1], name)
+    if declaration == None:
+      self.stack.append([None, 0, 0, []])
+      return
+
+    for attribute, value in attrs.iteritems():
+      if attribute.startswith(XSI + ' '):
+        continue
+      typename = declaration.attributes.get(attribute)
+      if typename == None:
+        if self.schema.lax:
+          continue
+        self.fail("unexpected attribute %s on %s" % (attribute, self.local(name)))
+      self.check(typename, value, "attribute %s of %s" % (attribute, self.local(name)))
+    for attribute in declaration.required:
+      if attribute not in attrs:
+        self.fail("%s is missing the required attribute %s" % (self.local(name), attribute))
+
+    self.stack.append([declaration, 0, 0, []])
+
+  def child(self, state, name):
+    """Advance the content model of the current element to the child name and return its declaration.
+
+       A lax schema returns None for an element after the declared children,  which is skipped.
+    """
+    declaration = state[0]
+    while state[1] < len(declaration.children):
+      (child, childDeclaration, minOccurs, maxOccurs) = declaration.children[state[1]]
+      if child == name:
+        if maxOccurs != None and state[2] >= maxOccurs:
+          self.fail("too many %s elements in %s" % (self.local(name), self.local(declaration.name)))
+        state[2] += 1
+        return childDeclaration
+      if state[2] < minOccurs:
+        self.fail("expected %s in %s instead of %s" % (self.local(child), self.local(declaration.name), self.local(name)))
+      state[1] += 1
+      state[2] = 0
+    if self.schema.lax:
+      return None
+    self.fail("unexpected element %s in %s" % (self.local(name), self.local(declaration.name)))
+
+  def endElement(self, name):
+    (declaration, index, occurrences, text) = self.stack.pop()
+    if declaration == None:
+      return
+    for (child, childDeclaration, minOccurs, maxOccurs) in declaration.children[index:]:
+      if occurrences < minOccurs:
+        self.fail("expected %s in %s" % (self.local(child), self.local(declaration.name)))
+      occurrences = 0
+    if declaration.text != None:
+      self.check(declaration.text, ''.join(text), "content of %s" % self.local(name))
+
+  def characters(self, content):
+    state = self.stack[-1]
+    if state[0] == None:
+      return
+    if state[0].text != None:
+      state[3].append(content)
+    elif content.strip():
+      self.fail("unexpected text in %s" % self.local(state[0].name))
+
+_lot_schema = None
+
+def validate(body):
+  """Validate a lot leniently against the bundled lot.xsd,  the schema is compiled on first use.
+
+     >>> validate('<lot xmlns="http://cmdb.elex.be/products/electronic-wafermapping/schemas/lot" name="A1"><wafer number="1"/></lot>')
+     >>> validate('<lot xmlns="http://cmdb.elex.be/products/electronic-wafermapping/schemas/lot" name="A1" site="erfurt">'
+     ...          '<wafer number="1" yield="98"><wafermaps/><notes><note>x</note></notes></wafer></lot>')
+     >>> try:
+     ...   validate('<lot name="A1"/>')
+     ... except InvalidLot, e:
+     ...   print e
+     line 1, column 0: unexpected root element lot
+  """
+  global _lot_schema
+  if _lot_schema == None:
+    # lot.xsd only lists a subset of the published schema
+    _lot_schema = Schema(LOT_XSD, lax=True)
+  _lot_schema.validate(body)
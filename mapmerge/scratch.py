@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+""" Reusable scratch directories for the input and output wafermaps of mapmerge.
+
+    Wafermaps only live for the duration of one merge,  so the directories can be kept
+    on a ram backed filesystem like /dev/shm and reused instead of being recreated.
+"""
+import errno
+import logging
+import os
+import shutil
+import threading
+
+from tempfile import mkdtemp
+
+logger = logging.getLogger(__name__)
+
+class ScratchPool:
+  """Hands out empty directories under the subdirectory name of root and keeps them for reuse when they
+     are released.
+
+     The subdirectory is wiped when the pool is created,  so the wafermaps a previous process left behind
+     don't stay in memory.  When root doesn't exist or its filesystem is fuller then the watermark ( a fraction
+     between 0 and 1 ) the directories are created in the default temporary directory and removed when they
+     are released.
+
+     >>> d = mkdtemp()
+     >>> scratch = ScratchPool(d, 1.0)
+     >>> ind = scratch.acquire()
+     >>> os.path.dirname(ind) == os.path.join(d, 'mapmerge')
+     True
+     >>> open(ind + '/wafermap', 'w').write('WMAP')
+     >>> scratch.release(ind)
+     >>> scratch.acquire() == ind
+     True
+     >>> os.listdir(ind)
+     []
+     >>> scratch = ScratchPool(d, 1.0)
+     >>> os.listdir(d)
+     []
+     >>> shutil.rmtree(d)
+  """
+
+  def __init__(self, root, watermark, name='mapmerge'):
+    self.root = root
+    self.directory = None
+    if root != None:
+      self.directory = os.path.join(root, name)
+    self.watermark = watermark
+    self.lock = threading.Lock()
+    self.free = []
+    self.wipe()
+
+  def wipe(self):
+    """Remove the scratch directories of a previous process"""
+    if self.directory != None and os.path.isdir(self.directory):
+      logger.debug('Removing the scratch directories in %s' % self.directory)
+      shutil.rmtree(self.directory, ignore_errors=True)
+
+  def _usable(self):
+    """Check if the scratch root exists and has space left"""
+    if self.root == None or not os.path.isdir(self.root):
+      return False
+    st = os.statvfs(self.root)
+    if st.f_blocks == 0:
+      return True
+    used = 1.0 - float(st.f_bavail) / st.f_blocks
+    if used > self.watermark:
+      logger.debug('Scratch directory %s is %d%% full,  using the default temporary directory' % (self.root, used * 100))
+      return False
+    return True
+
+  def _owns(self, d):
+    return self.directory != None and os.path.dirname(d) == self.directory
+
+  def acquire(self):
+    """Return an empty directory"""
+    if not self._usable():
+      return mkdtemp(prefix='mapmerge')
+    self.lock.acquire()
+    try:
+      if len(self.free) > 0:
+        return self.free.pop()
+    finally:
+      self.lock.release()
+    try:
+      os.mkdir(self.directory)
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+    return mkdtemp(prefix='mapmerge', dir=self.directory)
+
+  def release(self, d):
+    """Wipe a directory and keep it for the next acquire"""
+    if not self._owns(d) or not self._usable():
+      shutil.rmtree(d, ignore_errors=True, onerror=None)
+      return
+
+    try:
+      for name in os.listdir(d):
+        path = os.path.join(d, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+          shutil.rmtree(path)
+        else:
+          os.unlink(path)
+    except OSError, e:
+      logger.warning('Unable to wipe scratch directory %s: %s' % (d, e))
+      shutil.rmtree(d, ignore_errors=True, onerror=None)
+      return
+
+    self.lock.acquire()
+    try:
+      self.free.append(d)
+    finally:
+      self.lock.release()
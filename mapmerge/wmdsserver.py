@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+""" A local stand-in for the wmds to test the http client and mapmerge against
+
+    Wafermaps are kept in memory by their sha1,  like the wmds does.
+"""
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import tarfile
+import threading
+import time
+
+from cStringIO import StringIO
+
+class WMDSServer:
+  """Serves the wmds api on a free port of localhost in a background thread.
+
+     GET <url><reference> returns a wafermap,  PUT <url> stores the body and returns its reference and
+     POST <url>bulk with a reference per line returns a tar stream of the wafermaps that were found.
+     Set bulk to False to act as a wmds without bulk endpoint.
+
+     >>> import http
+     >>> server = WMDSServer()
+     >>> reference = http.put(server.url, data='WMAP').text
+     >>> reference
+     '782dcc19e66f55849b85de9fc3b2e83a29df5d3c'
+     >>> http.get(server.url + reference).text
+     'WMAP'
+     >>> http.get(server.url + '716c6b31cc6f3be514269de58c4097da89abdcdc').status_code
+     404
+     >>> http._session.close()
+     >>> server.shutdown()
+  """
+
+  def __init__(self, bulk=True, path='/api/wafermap/'):
+    self.bulk = bulk
+    self.path = path
+    self.wafermaps = {}
+    self.requests = 0
+    self.lock = threading.Lock()
+    self.server = _Server(('127.0.0.1', 0), _Handler)
+    self.server.wmds = self
+    self.url = 'http://127.0.0.1:%d%s' % (self.server.server_address[1], path)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+  def add(self, wafermap):
+    """Store a wafermap and return its reference"""
+    reference = hashlib.sha1(wafermap).hexdigest()
+    self.wafermaps[reference] = wafermap
+    return reference
+
+  def shutdown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def count(self):
+    self.lock.acquire()
+    try:
+      self.requests += 1
+    finally:
+      self.lock.release()
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # the status line,  headers and body of a reply go out in one write instead of in separate segments,
+  # which nagle and delayed acks would hold back on kept alive connections
+  wbufsize = -1
+
+  def reply(self, status, body, content_type='text/plain'):
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+    self.wfile.flush()
+
+  def body(self):
+    return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+  def do_GET(self):
+    wmds = self.server.wmds
+    wmds.count()
+    wafermap = wmds.wafermaps.get(self.path[len(wmds.path):])
+    if not self.path.startswith(wmds.path) or wafermap == None:
+      self.reply(404, 'Not found')
+    else:
+      self.reply(200, wafermap, 'application/octet-stream')
+
+  def do_PUT(self):
+    wmds = self.server.wmds
+    wmds.count()
+    self.reply(201, wmds.add(self.body()))
+
+  def do_POST(self):
+    wmds = self.server.wmds
+    wmds.count()
+    references = self.body().split()
+    if not wmds.bulk or self.path != wmds.path + 'bulk':
+      self.reply(404, 'Not found')
+      return
+
+    out = StringIO()
+    archive = tarfile.open(fileobj=out, mode='w|')
+    for reference in references:
+      wafermap = wmds.wafermaps.get(reference)
+      if wafermap == None:
+        continue
+      info = tarfile.TarInfo(reference)
+      info.size = len(wafermap)
+      info.mtime = time.time()
+      archive.addfile(info, StringIO(wafermap))
+    archive.close()
+    self.reply(200, out.getvalue(), 'application/x-tar')
+
+  def log_message(self, format, *args):
+    pass
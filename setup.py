@@ -5,7 +5,8 @@ setup(
     description='electronic wafermap processor for mapmerge',
     version='1.1.0',
     long_description=__doc__,
-    packages=find_packages(exclude=["*.tests", "*.tests.*", "tests.*", "tests", '*send_job.py', '*stomptest.py']),
+    packages=find_packages(exclude=["*.tests", "*.tests.*", "tests.*", "tests", '*send_job.py', '*stomptest.py', '*wmdsserver.py']),
+    package_data={'mapmerge': ['lot.xsd']},
     zip_safe=False,
     install_requires=[],
     scripts=['python-mapmerge']
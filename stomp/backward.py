@@ -15,6 +15,27 @@ else: # Python 2
 
 def socksend(conn, msg):
     conn.sendall(encode(msg))
+
+# the most pieces handed to one sendmsg call, well below the IOV_MAX of the common platforms
+SENDMSG_MAX_PIECES = 512
+
+def socksendmsg(conn, pieces):
+    """
+    Send a list of byte strings with vectored writes instead of joining them first.
+    Only sockets with a sendmsg method (python 3.3 and up, not ssl) can do this.
+    """
+    views = [memoryview(piece) for piece in pieces if len(piece) > 0]
+    i = 0
+    while i < len(views):
+        sent = conn.sendmsg(views[i:i + SENDMSG_MAX_PIECES])
+        # skip the pieces that were sent completely and the sent part of the next one
+        while sent > 0:
+            size = len(views[i])
+            if sent < size:
+                views[i] = views[i][sent:]
+                break
+            sent -= size
+            i += 1
         
 class uuid(object):
     def uuid4(*args):
@@ -1,6 +1,5 @@
 import math
 import random
-import re
 import socket
 import sys
 import threading
@@ -8,11 +7,6 @@ import time
 import types
 import xml.dom.minidom
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from io import StringIO
-
 try:
     import ssl
     from ssl import SSLError
@@ -30,10 +24,17 @@ try:
 except ImportError:
     LINUX_KEEPALIVE_AVAIL=False
 
+try:
+    from socket import IPPROTO_TCP, TCP_CORK
+except ImportError:
+    TCP_CORK = None
+
+from contextlib import contextmanager
+
 import exception
 import listener
 import utils
-from backward import decode, encode, hasbyte, pack, socksend, NULL
+from backward import encode, hasbyte, pack, socksend, socksendmsg, NULL
 
 try:
     import uuid    
@@ -48,6 +49,29 @@ except ImportError:
 import logging
 log = logging.getLogger('stomp.py')
 
+# frames with a payload of at least this many bytes are written without copying the payload
+# into the frame, smaller frames are cheaper to join and send with one write
+UNCOPIED_PAYLOAD_SIZE = 65536
+
+def coalesce(pieces, size=UNCOPIED_PAYLOAD_SIZE):
+    """
+    Join each run of pieces smaller than size, pieces of at least size bytes are kept as they are.
+
+    >>> list(coalesce([ 'a', 'b', 'x' * 4, 'c', 'd' ], 4))
+    ['ab', 'xxxx', 'cd']
+    """
+    run = [ ]
+    for piece in pieces:
+        if len(piece) < size:
+            run.append(piece)
+            continue
+        if run:
+            yield pack(run)
+            run = [ ]
+        yield piece
+    if run:
+        yield pack(run)
+
 class Connection(object):
     """
     Represents a STOMP client connection.
@@ -76,11 +100,6 @@ class Connection(object):
     except:
         pass
     
-    #
-    # Used to parse the STOMP "content-length" header lines,
-    #
-    __content_length_re = re.compile('^content-length[:]\\s*(?P<value>[0-9]+)', re.MULTILINE)
-
     def __init__(self, 
                  host_and_ports = [ ('localhost', 61613) ], 
                  user = None,
@@ -103,7 +122,8 @@ class Connection(object):
                  version = 1.0,
                  strict = True,
                  heartbeats = (0, 0),
-                 keepalive = None
+                 keepalive = None,
+                 recv_size = 65536
                  ):
         """
         Initialize and start this connection.
@@ -205,6 +225,11 @@ class Connection(object):
             default keepalive options for your OS, or as a tuple of
             values, which also enables keepalive packets, but specifies
             options specific to your OS implementation
+
+        \param recv_size
+            the maximum number of bytes received from the socket at once. Frames
+            are received into a buffer that grows as needed, so a frame larger
+            than recv_size only takes more reads.
         """
 
         sorted_host_and_ports = []
@@ -236,7 +261,7 @@ class Connection(object):
         self.__host_and_ports.extend(loopback_host_and_ports)
         self.__host_and_ports.extend(sorted_host_and_ports)
 
-        self.__recvbuf = ''
+        self.__parser = utils.FrameParser(recv_size)
 
         self.__listeners = {}
 
@@ -254,6 +279,8 @@ class Connection(object):
 
         self.__socket = None
         self.__socket_semaphore = threading.BoundedSemaphore(1)
+        # the frames collected by batch, per thread
+        self.__batches = threading.local()
         self.__current_host_and_port = None
 
         self.__receiver_thread_exit_condition = threading.Condition()
@@ -429,12 +456,50 @@ class Connection(object):
         
         # if we need to wait-on-receipt, then block until the receipt frame arrives 
         if self.__wait_on_receipt and 'receipt' in merged_headers.keys():
+            # the receipt can't arrive before the batched frames are sent
+            self.__flush_batch()
             receipt = merged_headers['receipt']
             while receipt not in self.__receipts:
                 self.__send_wait_condition.wait()
             self.__send_wait_condition.release()
             del self.__receipts[receipt]
     
+    @contextmanager
+    def batch(self):
+        """
+        Collect the frames this thread sends inside a with block and write them to the socket
+        together when the block ends, for example a message and the ACK of the message it answers.
+        Frames sent by other threads meanwhile are written straight away.  Nested batches are
+        written when the outermost one ends.
+
+            with conn.batch():
+                conn.send(result, destination='/queue/out')
+                conn.ack({ 'message-id' : message_id })
+        """
+        if getattr(self.__batches, 'pieces', None) is not None:
+            yield
+            return
+        self.__batches.pieces = [ ]
+        try:
+            yield
+        finally:
+            try:
+                self.__flush_batch()
+            finally:
+                self.__batches.pieces = None
+
+    def __flush_batch(self):
+        """
+        Write the frames collected by the batch of this thread, if there is one.
+        """
+        pieces = getattr(self.__batches, 'pieces', None)
+        if not pieces:
+            return
+        self.__batches.pieces = [ ]
+        if self.__socket is None:
+            raise exception.NotConnectedException()
+        self.__send_pieces(pieces)
+
     def ack(self, headers={}, **keyword_headers):
         """
         Send an ACK frame, to acknowledge receipt of a message
@@ -535,6 +600,8 @@ class Connection(object):
         """
         try:
             self.__send_frame_helper('DISCONNECT', '', utils.merge_headers([self.__connect_headers, headers, keyword_headers]), [ ])
+            # the socket is closed below, so a batch can't wait until it ends
+            self.__flush_batch()
         except exception.NotConnectedException:
             _, e, _ = sys.exc_info()
             self.disconnect_socket()
@@ -615,28 +682,31 @@ class Connection(object):
             
         if self.__socket is not None:
             try:
-                frame = [ ]                
+                preamble = [ ]                
                 if command is not None:
-                    frame.append(command + '\n')
+                    preamble.append(command + '\n')
                     
                 for key, val in headers.items():
-                    frame.append('%s:%s\n' % (key, val))
+                    preamble.append('%s:%s\n' % (key, val))
                         
-                frame.append('\n')
-                    
+                preamble.append('\n')
+
+                # the payload is kept as a piece of its own, so a large one is never copied
+                frame = [ pack(preamble) ]
                 if payload:
                     frame.append(payload)
                     
                 if command is not None:
                     # only send the terminator if we're sending a command (heartbeats have no term)
                     frame.append(NULL)
-                frame = pack(frame)
-                self.__socket_semaphore.acquire()
-                try:
-                    socksend(self.__socket, frame)
+
+                batch = getattr(self.__batches, 'pieces', None)
+                if batch is not None:
+                    batch.extend(frame)
+                    log.debug("Batched frame: type=%s, headers=%r, body=%r" % (command, headers, payload))
+                else:
+                    self.__send_pieces(frame)
                     log.debug("Sent frame: type=%s, headers=%r, body=%r" % (command, headers, payload))
-                finally:
-                    self.__socket_semaphore.release()
             except Exception:
                 _, e, _ = sys.exc_info()
                 log.error("Error sending frame: %s" % e)
@@ -644,6 +714,37 @@ class Connection(object):
         else:
             raise exception.NotConnectedException()
 
+    def __send_pieces(self, pieces):
+        """
+        Write the pieces of one or more frames to the socket with as few system calls as possible.
+        Sockets with sendmsg get one vectored write.  Otherwise, when a piece is large, the socket
+        is corked while it is written on its own and the small pieces around it are joined, so the
+        payload is not copied and the kernel still sends full packets.  Small pieces are simply joined.
+
+        \param pieces
+            a list of byte strings
+        """
+        self.__socket_semaphore.acquire()
+        try:
+            if len(pieces) > 1 and not self.__ssl and hasattr(self.__socket, 'sendmsg'):
+                socksendmsg(self.__socket, pieces)
+            elif len(pieces) > 1 and TCP_CORK is not None and max([ len(piece) for piece in pieces ]) >= UNCOPIED_PAYLOAD_SIZE:
+                try:
+                    self.__socket.setsockopt(IPPROTO_TCP, TCP_CORK, 1)
+                except socket.error:
+                    # not a tcp socket
+                    socksend(self.__socket, pack(pieces))
+                else:
+                    try:
+                        for piece in coalesce(pieces):
+                            socksend(self.__socket, piece)
+                    finally:
+                        self.__socket.setsockopt(IPPROTO_TCP, TCP_CORK, 0)
+            else:
+                socksend(self.__socket, pack(pieces))
+        finally:
+            self.__socket_semaphore.release()
+
     def __notify(self, frame_type, headers=None, body=None):
         """
         Utility function for notifying listeners of incoming and outgoing messages
@@ -717,8 +818,7 @@ class Connection(object):
                             while self.__running:
                                 frames = self.__read()
                                 
-                                for frame in frames:
-                                    (frame_type, headers, body) = utils.parse_frame(frame)
+                                for (frame_type, headers, body) in frames:
                                     log.debug("Received frame: %r, headers=%r, body=%r" % (frame_type, headers, body))
                                     frame_type = frame_type.lower()
                                     if frame_type in [ 'connected', 'message', 'receipt', 'error' ]:
@@ -727,7 +827,7 @@ class Connection(object):
                                         # no notifications needed
                                         pass
                                     else:
-                                        log.warning('Unknown response frame type: "%s" (frame length was %d)' % (frame_type, len(frame)))
+                                        log.warning('Unknown response frame type: "%s" (body length was %d)' % (frame_type, len(body)))
                         finally:
                             try:
                                 self.__socket.close()
@@ -742,7 +842,7 @@ class Connection(object):
                             #
                             # Clear out any half-received messages after losing connection
                             #
-                            self.__recvbuf = ''
+                            self.__parser.reset()
                             self.__running = False
                         break
             except:
@@ -796,59 +896,20 @@ class Connection(object):
         """
         Read the next frame(s) from the socket.
         """
-        fastbuf = StringIO()
         while self.__running:
+            frames = self.__parser.frames()
+            if frames:
+                return frames
             try:
-                c = self.__socket.recv(1024)
-                c = decode(c)
+                n = self.__parser.receive(self.__socket)
                 
                 # reset the heartbeat for any received message
                 self.__received_heartbeat = time.time()
             except Exception:
-                _, e, _ = sys.exc_info()
-                c = ''
-            if len(c) == 0:
+                n = 0
+            if n == 0:
                 raise exception.ConnectionClosedException()
-            fastbuf.write(c)
-            if '\x00' in c:
-                break
-            elif c == '\x0a':
-                # heartbeat (special case)
-                return c
-        self.__recvbuf += fastbuf.getvalue()
-        fastbuf.close() 
-        result = []
-        
-        if len(self.__recvbuf) > 0 and self.__running:
-            while True:
-                pos = self.__recvbuf.find('\x00')
-
-                if pos >= 0:
-                    frame = self.__recvbuf[0:pos]
-                    preamble_end = frame.find('\n\n')
-                    if preamble_end >= 0:
-                        content_length_match = Connection.__content_length_re.search(frame[0:preamble_end])
-                        if content_length_match:
-                            content_length = int(content_length_match.group('value'))
-                            content_offset = preamble_end + 2
-                            frame_size = content_offset + content_length
-                            if frame_size > len(frame):
-                                #
-                                # Frame contains NUL bytes, need to read more
-                                #
-                                if frame_size < len(self.__recvbuf):
-                                    pos = frame_size
-                                    frame = self.__recvbuf[0:pos]
-                                else:
-                                    #
-                                    # Haven't read enough data yet, exit loop and wait for more to arrive
-                                    #
-                                    break
-                    result.append(frame)
-                    self.__recvbuf = self.__recvbuf[pos+1:]
-                else:
-                    break
-        return result
+        return []
 
     def __enable_keepalive(self):
         def try_setsockopt(sock, name, fam, opt, val):
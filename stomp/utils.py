@@ -1,6 +1,8 @@
 import re
 import xml.dom
 
+from backward import decode, encode, NULL
+
 try:
     import hashlib
 except ImportError:
@@ -11,6 +13,26 @@ except ImportError:
 #
 HEADER_LINE_RE = re.compile('(?P<key>[^:]+)[:](?P<value>.*)')
 
+try:
+    memoryview
+except NameError: # python version < 2.7
+    memoryview = None
+
+try:
+    bytearray
+except NameError: # python version < 2.6, the received data is kept in a str instead
+    bytearray = None
+    bytes = str
+
+# the items of a bytearray are numbers, those of a str are strings
+if bytearray is not None:
+    LF_ITEM, CR_ITEM = 10, 13
+else:
+    LF_ITEM, CR_ITEM = '\n', '\r'
+
+EOL = encode('\n')
+PREAMBLE_END = encode('\n\n')
+
 
 def parse_headers(lines, offset=0):
     headers = {}
@@ -123,4 +145,189 @@ def calculate_heartbeats(shb, chb):
         x = max(cx, int(sy))
     if cy != 0 and sx != '0':
         y = max(cy, int(sx))
-    return (x, y)
\ No newline at end of file
+    return (x, y)
+
+class FrameParser(object):
+    """
+    Incremental STOMP frame parser.
+
+    Received data is added with feed or receive. Each call to frames returns the
+    frames that were completed since, as (frame_type, headers, body) tuples like
+    parse_frame. The command and the headers are parsed once, and the body is read
+    by its content-length or up to the first NUL byte.
+
+    >>> parser = FrameParser()
+    >>> parser.feed('\\nMESSAGE\\ndestination:/queue/a\\ncontent-le')
+    >>> parser.frames()
+    []
+    >>> parser.feed('ngth:5\\n\\nab\\x00cd\\x00RECEIPT\\nreceipt-id:1\\n\\n\\x00')
+    >>> parser.frames()
+    [('MESSAGE', {'content-length': '5', 'destination': '/queue/a'}, 'ab\\x00cd'), ('RECEIPT', {'receipt-id': '1'}, '')]
+    """
+    COMMAND = 0
+    HEADERS = 1
+    BODY = 2
+
+    def __init__(self, recv_size = 65536):
+        """
+        \param recv_size
+            the maximum number of bytes received at once by receive
+        """
+        self.recv_size = recv_size
+        self.reset()
+
+    def reset(self):
+        """
+        Forget all received data, for example after losing the connection.
+        """
+        # the received data lives in buf between start and end, pos is where parsing continues
+        if bytearray is not None:
+            self.buf = bytearray(self.recv_size)
+        else:
+            self.buf = encode('')
+        self.start = 0
+        self.end = 0
+        self.pos = 0
+        self.state = FrameParser.COMMAND
+        self.frame_type = None
+        self.headers = None
+        self.content_length = None
+
+    def __reserve(self, size):
+        """
+        Make room for size more bytes at the end of the buffer.
+
+        Only the start of an incomplete frame is moved, and the buffer doubles when
+        it's too small, so a frame of n bytes is received in O(n).
+        """
+        if bytearray is None:
+            # a str grows when data is added, only the parsed data is dropped
+            if self.start > 0:
+                self.buf = self.buf[self.start:self.end]
+                self.pos -= self.start
+                self.end -= self.start
+                self.start = 0
+            return
+        if self.start == self.end:
+            self.pos -= self.start
+            self.start = self.end = 0
+            # give back the memory of a large frame once it is parsed
+            if len(self.buf) > 4 * self.recv_size and self.state == FrameParser.COMMAND:
+                self.buf = bytearray(self.recv_size)
+        buf = self.buf
+        if len(buf) - self.end < size:
+            if self.start > 0:
+                pending = self.end - self.start
+                buf[0:pending] = buf[self.start:self.end]
+                self.pos -= self.start
+                self.start = 0
+                self.end = pending
+            if len(buf) - self.end < size:
+                buf.extend(bytearray(max(len(buf), size)))
+
+    def feed(self, data):
+        """
+        Add received data.
+        """
+        data = encode(data)
+        self.__reserve(len(data))
+        self.__append(data)
+
+    def __append(self, data):
+        if bytearray is not None:
+            self.buf[self.end:self.end + len(data)] = data
+        else:
+            self.buf += data
+        self.end += len(data)
+
+    def receive(self, sock):
+        """
+        Receive up to recv_size bytes from a socket straight into the buffer and
+        return the number of bytes received, 0 when the socket is closed.
+        """
+        self.__reserve(self.recv_size)
+        if memoryview is not None:
+            n = sock.recv_into(memoryview(self.buf)[self.end:], self.recv_size)
+            self.end += n
+        else:
+            data = sock.recv(self.recv_size)
+            n = len(data)
+            self.__append(data)
+        return n
+
+    def __line(self):
+        """
+        Return the next complete line, or None when it hasn't been received yet.
+        """
+        eol = self.buf.find(EOL, self.pos, self.end)
+        if eol < 0:
+            self.pos = self.end
+            return None
+        line = decode(bytes(self.buf[self.start:eol]))
+        self.start = self.pos = eol + 1
+        return line
+
+    def frames(self):
+        """
+        Return the frames completed by the data received so far.
+        """
+        buf = self.buf
+        result = []
+        while self.start < self.end:
+            if self.state == FrameParser.COMMAND:
+                # skip heartbeats and the end of line between frames
+                if buf[self.start] in (LF_ITEM, CR_ITEM):
+                    self.start += 1
+                    self.pos = self.start
+                    continue
+                line = self.__line()
+                if line is None:
+                    break
+                self.frame_type = line
+                self.headers = {}
+                self.content_length = None
+                self.state = FrameParser.HEADERS
+
+            elif self.state == FrameParser.HEADERS:
+                # the headers are parsed at once when the empty line after them has arrived
+                if buf[self.start] == LF_ITEM:
+                    header_end = self.start - 1
+                else:
+                    header_end = buf.find(PREAMBLE_END, max(self.start, self.pos - 1), self.end)
+                    if header_end < 0:
+                        self.pos = self.end
+                        break
+                    for line in decode(bytes(buf[self.start:header_end])).split('\n'):
+                        colon = line.find(':')
+                        if colon > 0:
+                            key = line[:colon]
+                            if key not in self.headers:
+                                self.headers[key] = line[colon + 1:]
+                    if 'content-length' in self.headers:
+                        self.content_length = int(self.headers['content-length'].strip())
+                self.start = self.pos = header_end + 2
+                self.state = FrameParser.BODY
+
+            else:
+                if self.content_length is not None:
+                    body_end = self.start + self.content_length
+                    if body_end >= self.end:
+                        # wait for the body and the terminating NUL
+                        self.pos = self.end
+                        break
+                else:
+                    body_end = buf.find(NULL, self.pos, self.end)
+                    if body_end < 0:
+                        # continue the search where it stopped when more data arrives
+                        self.pos = self.end
+                        break
+                if memoryview is not None:
+                    body = decode(memoryview(buf)[self.start:body_end].tobytes())
+                else:
+                    body = decode(str(buf[self.start:body_end]))
+                if 'transformation' in self.headers:
+                    body = transform(body, self.headers['transformation'])
+                result.append((self.frame_type, self.headers, body))
+                self.start = self.pos = body_end + 1
+                self.state = FrameParser.COMMAND
+        return result